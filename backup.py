@@ -0,0 +1,462 @@
+# -*- coding: utf-8 -*-
+try:
+    import ogr
+except ImportError:
+    from osgeo import ogr
+import hashlib
+import json
+import os
+import shutil
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from geonode.layers.models import Attribute, Layer
+
+from cartoview.log_handler import get_logger
+
+from .constants import BackupLayer, TableStats
+from .handlers import DataManager, get_connection
+from .models import BackupManifest, LayerSchema
+from .pools import get_http_session, get_psycopg2_pool
+from .postgis_loader import quote_ident
+from .style_manager import StyleManager
+from .utils import get_new_dir, get_sld_body
+
+logger = get_logger(__name__)
+
+BACKUP_WORKERS = getattr(settings, 'DATA_MANAGER_BACKUP_WORKERS', 4)
+BACKUP_STYLE_WORKERS = getattr(settings, 'DATA_MANAGER_BACKUP_STYLE_WORKERS',
+                               8)
+# hash the rows of tables with changed statistics to skip no-op writes
+BACKUP_CONTENT_HASH = getattr(settings, 'DATA_MANAGER_BACKUP_CONTENT_HASH',
+                              False)
+# differential backups in a chain before the next full backup
+BACKUP_MAX_CHAIN = getattr(settings, 'DATA_MANAGER_BACKUP_MAX_CHAIN', 7)
+MANIFEST_TABLE = 'backup_manifest'
+BACKUP_PROGRESS_INTERVAL = getattr(settings,
+                                   'DATA_MANAGER_BACKUP_PROGRESS_INTERVAL', 1)
+
+
+class BackupProgress(object):
+    """
+    thread safe progress of a backup run. report(event) receives dicts
+    with the stage, layers done/total, rows and bytes written,
+    throughput and eta at most once per interval seconds
+    and on every stage change
+    """
+
+    def __init__(self, report=None, interval=BACKUP_PROGRESS_INTERVAL):
+        self.report = report
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._reported_at = 0
+        self.started_at = time.time()
+        self.stage = 'prepare'
+        self.layers_total = 0
+        self.layers_done = 0
+        self.rows = 0
+        self.bytes_written = 0
+        # datastore size of the tables to export and of the exported ones
+        self.source_total = 0
+        self.source_done = 0
+
+    def as_dict(self):
+        elapsed = max(time.time() - self.started_at, 0.001)
+        eta = None
+        if self.source_total and self.source_done:
+            eta = (self.source_total - self.source_done) * elapsed / \
+                self.source_done
+        elif self.layers_total and self.layers_done:
+            eta = (self.layers_total - self.layers_done) * elapsed / \
+                self.layers_done
+        return {
+            "stage": self.stage,
+            "layers_done": self.layers_done,
+            "layers_total": self.layers_total,
+            "rows": self.rows,
+            "bytes": self.bytes_written,
+            "rows_per_second": self.rows / elapsed,
+            "bytes_per_second": self.bytes_written / elapsed,
+            "elapsed": elapsed,
+            "eta": eta
+        }
+
+    def emit(self, force=False):
+        if not self.report:
+            return
+        now = time.time()
+        with self._lock:
+            if not force and now - self._reported_at < self.interval:
+                return
+            self._reported_at = now
+            event = self.as_dict()
+        try:
+            self.report(event)
+        except Exception as e:
+            logger.warning(e)
+
+    def set_stage(self, stage):
+        with self._lock:
+            self.stage = stage
+        self.emit(force=True)
+
+    def start(self, layers_total, source_total):
+        with self._lock:
+            self.layers_total = layers_total
+            self.source_total = source_total
+        self.set_stage('export')
+
+    def layer_done(self, rows, bytes_written, source_bytes):
+        with self._lock:
+            self.layers_done += 1
+            self.rows += rows
+            self.bytes_written += bytes_written
+            self.source_done += source_bytes
+        self.emit()
+
+
+class PortalBackup(object):
+    """
+    export the portal layers and their default styles to one geopackage.
+    tables are copied in parallel, one datastore connection and one
+    temporary geopackage per worker, and the parts are merged at the end
+    """
+
+    def __init__(self,
+                 connection_string=None,
+                 workers=BACKUP_WORKERS,
+                 style_workers=BACKUP_STYLE_WORKERS,
+                 progress=None):
+        self.connection_string = connection_string or get_connection()
+        self.progress = progress or BackupProgress()
+        self.workers = max(workers, 1)
+        self.style_workers = max(style_workers, 1)
+
+    def get_table_stats(self):
+        """
+        every table of the search path in one query as
+        {schema.name: TableStats} ordered by the search path,
+        writes is the number of inserted, updated and deleted rows
+        and is None for views
+        """
+        with get_psycopg2_pool(self.connection_string).connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT n.nspname, c.relname, pg_total_relation_size(c.oid), \
+                s.n_live_tup, s.n_tup_ins + s.n_tup_upd + s.n_tup_del, \
+                c.oid, pg_relation_filenode(c.oid), \
+                pg_stat_get_db_stat_reset_time(d.oid)::text \
+                FROM pg_class c JOIN pg_namespace n ON n.oid = c.relnamespace \
+                JOIN pg_database d ON d.datname = current_database() \
+                LEFT JOIN pg_stat_user_tables s ON s.relid = c.oid \
+                WHERE n.nspname = ANY (current_schemas(false)) \
+                AND c.relkind IN ('r', 'v', 'm', 'p', 'f') \
+                ORDER BY array_position(current_schemas(false), n.nspname)")
+            return OrderedDict(("{}.{}".format(row[0], row[1]),
+                                TableStats(*row))
+                               for row in cursor.fetchall())
+
+    @staticmethod
+    def visible_tables(stats):
+        # {name: stats} of the tables an unqualified name resolves to
+        tables = {}
+        for table in stats.values():
+            tables.setdefault(table.name, table)
+        return tables
+
+    def get_content_hash(self, table):
+        # order independent hash of the table rows
+        with get_psycopg2_pool(self.connection_string).connection() as conn:
+            cursor = conn.cursor()
+            cursor.execute(
+                "SELECT md5(coalesce(string_agg(h, '' ORDER BY h), '')) \
+                FROM (SELECT md5(t::text) AS h FROM {}.{} t) AS rows".format(
+                    quote_ident(table.schema), quote_ident(table.name)))
+            return cursor.fetchone()[0]
+
+    def collect_layers(self, tables, layers=None):
+        if layers is None:
+            layers = Layer.objects.all()
+        layers = layers.select_related('default_style')
+        geom_attrs = dict(
+            Attribute.objects.filter(
+                layer__in=layers, attribute_type__contains='gml').values_list(
+                    'layer_id', 'attribute'))
+        backup_layers = []
+        seen = set()
+        for layer in layers:
+            table_name = str(layer.alternate).split(":").pop()
+            if table_name not in tables or table_name in seen:
+                continue
+            seen.add(table_name)
+            style = layer.default_style
+            gattr = geom_attrs.get(layer.id)
+            backup_layers.append(
+                BackupLayer(table_name,
+                            str(gattr) if gattr else None,
+                            str(style.name) if style else None,
+                            style.sld_url if style else None))
+        return backup_layers
+
+    @staticmethod
+    def style_checksum(sld_body):
+        return hashlib.md5(sld_body.encode('utf-8')).hexdigest()
+
+    def get_changed_tables(self, table_names, stats, previous):
+        """
+        tables changed since the previous manifest entries, returns
+        (changed table names, {table name: manifest entry})
+        """
+        changed = []
+        entries = {}
+        for table_name in table_names:
+            table = stats[table_name]
+            entry = {
+                "schema": table.schema,
+                "oid": table.oid,
+                "filenode": table.filenode,
+                "stats_reset": table.stats_reset,
+                "rows": table.rows,
+                "writes": table.writes,
+                "hash": None
+            }
+            old = previous.get(table_name)
+            # the counters only compare within the same physical table
+            # and the same statistics period
+            same_table = old and all(
+                old.get(key) == entry[key]
+                for key in ("schema", "oid", "filenode", "stats_reset"))
+            unchanged = same_table and table.writes is not None and \
+                old.get("rows") == table.rows and \
+                old.get("writes") == table.writes
+            if not unchanged and old and table.writes is not None and \
+                    BACKUP_CONTENT_HASH:
+                entry["hash"] = self.get_content_hash(table)
+                unchanged = entry["hash"] == old.get("hash")
+            if unchanged:
+                entry["hash"] = old.get("hash")
+            else:
+                changed.append(table_name)
+            entries[table_name] = entry
+        return changed, entries
+
+    def fetch_styles(self, backup_layers):
+        session = get_http_session('geoserver')
+
+        def fetch(layer):
+            try:
+                return (layer.table_name, layer.geom_attr, layer.style_name,
+                        get_sld_body(layer.sld_url, session=session))
+            except Exception as e:
+                logger.error("Failed to fetch the style of {}: {}".format(
+                    layer.table_name, e))
+                return None
+
+        with ThreadPoolExecutor(max_workers=self.style_workers) as executor:
+            styles = executor.map(
+                fetch, [layer for layer in backup_layers
+                        if layer.sld_url and layer.geom_attr])
+            return [style for style in styles if style]
+
+    def partition(self, table_names, sizes):
+        # largest tables first, each to the least loaded worker
+        parts = [[] for _ in range(min(self.workers, len(table_names)))]
+        loads = [0] * len(parts)
+        for name in sorted(table_names, key=lambda name: -sizes.get(name, 0)):
+            idx = loads.index(min(loads))
+            parts[idx].append(name)
+            loads[idx] += sizes.get(name, 0)
+        return parts
+
+    def export_part(self, path, table_names, sizes):
+        with DataManager.open_source(
+                self.connection_string, is_postgres=True) as source:
+            ds = ogr.GetDriverByName('GPKG').CreateDataSource(path)
+            try:
+                written = os.path.getsize(path)
+                for table_name in table_names:
+                    layer = source.GetLayerByName(str(table_name))
+                    rows = 0
+                    if not layer:
+                        logger.warning("{} not found".format(table_name))
+                    else:
+                        copied = ds.CopyLayer(layer, str(table_name))
+                        rows = copied.GetFeatureCount() if copied else 0
+                    size = os.path.getsize(path)
+                    self.progress.layer_done(rows, size - written,
+                                             sizes.get(table_name, 0))
+                    written = size
+            finally:
+                ds = None
+        return path
+
+    @staticmethod
+    def merge(parts, dest_path):
+        # the biggest part becomes the backup, the others are appended
+        parts = sorted((part for part in parts if os.path.exists(part)),
+                       key=os.path.getsize, reverse=True)
+        if not parts:
+            ogr.GetDriverByName('GPKG').CreateDataSource(dest_path)
+            return dest_path
+        shutil.move(parts[0], dest_path)
+        ds = ogr.Open(dest_path, 1)
+        try:
+            for part in parts[1:]:
+                source = ogr.Open(part)
+                for i in range(source.GetLayerCount()):
+                    layer = source.GetLayerByIndex(i)
+                    ds.CopyLayer(layer, layer.GetName())
+                source = None
+                os.remove(part)
+        finally:
+            ds = None
+        return dest_path
+
+    @staticmethod
+    def write_manifest(dest_path, manifest):
+        conn = sqlite3.connect(dest_path)
+        try:
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS {} (`id` INTEGER PRIMARY KEY \
+                AUTOINCREMENT, `manifest` TEXT)".format(MANIFEST_TABLE))
+            conn.execute(
+                "INSERT INTO {} (manifest) VALUES (?)".format(MANIFEST_TABLE),
+                (json.dumps(manifest), ))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def run(self, dest_path, layers=None, base=None):
+        """
+        backup the portal to dest_path, when base (a BackupManifest) is
+        given only the tables and styles changed since base are saved.
+        returns the BackupManifest of the new backup
+        """
+        stats = self.visible_tables(self.get_table_stats())
+        backup_layers = self.collect_layers(stats, layers=layers)
+        previous = base.get_tables() if base else {}
+        changed, entries = self.get_changed_tables(
+            [layer.table_name for layer in backup_layers], stats, previous)
+        changed_set = set(changed)
+        sizes = dict((name, stat.size or 0) for name, stat in stats.items())
+        table_names = changed
+        self.progress.start(len(table_names),
+                            sum(sizes.get(name, 0) for name in table_names))
+        parts_dir = get_new_dir()
+        try:
+            with ThreadPoolExecutor(max_workers=1) as style_executor:
+                # styles download while the tables are exported
+                styles = style_executor.submit(self.fetch_styles,
+                                               backup_layers)
+                jobs = [(os.path.join(parts_dir, "part_{}.gpkg".format(i)),
+                         names, sizes)
+                        for i, names in enumerate(
+                            self.partition(table_names, sizes))]
+                with ThreadPoolExecutor(
+                        max_workers=self.workers) as executor:
+                    parts = list(
+                        executor.map(lambda job: self.export_part(*job),
+                                     jobs))
+                self.progress.set_stage('merge')
+                self.merge(parts, dest_path)
+                self.progress.set_stage('styles')
+                styles = styles.result()
+            saved_styles = []
+            for style in styles:
+                entry = entries[style[0]]
+                entry["style"] = self.style_checksum(style[3])
+                old = previous.get(style[0]) or {}
+                if style[0] in changed_set or \
+                        entry["style"] != old.get("style"):
+                    saved_styles.append(style)
+            with StyleManager(dest_path) as stm:
+                stm.create_table()
+                stm.add_styles(saved_styles, default=True)
+            manifest = {
+                "tables": entries,
+                "changed": changed,
+                "styles": [style[0] for style in saved_styles],
+                "removed": sorted(set(previous) - set(entries)),
+            }
+            self.write_manifest(dest_path, manifest)
+        finally:
+            shutil.rmtree(parts_dir, ignore_errors=True)
+        self.progress.set_stage('done')
+        logger.info("{} layers and {} styles saved to {}".format(
+            len(table_names), len(saved_styles), dest_path))
+        return BackupManifest.objects.create(
+            file_path=dest_path,
+            base=base,
+            full=base is None,
+            manifest=json.dumps(manifest))
+
+    def restore(self, backup):
+        """
+        load the tables of backup into the datastore, every table is read
+        from the newest backup of the chain (full backup and its deltas)
+        that saved it, then reapply the saved styles.
+        returns {table name: backup file}
+        """
+        sources = {}
+        for link in backup.get_chain():
+            for table_name in link.get_manifest().get("changed", []):
+                sources[table_name] = link.file_path
+        sources = dict((name, path) for name, path in sources.items()
+                       if name in backup.get_tables())
+        for file_path in set(sources.values()):
+            manager = DataManager(file_path)
+            for table_name, path in sources.items():
+                if path == file_path:
+                    manager.layer_to_postgis(
+                        str(table_name), self.connection_string,
+                        overwrite=True, name=str(table_name))
+        if sources:
+            LayerSchema.index_tables([str(name) for name in sources])
+        self.restore_styles(backup)
+        return sources
+
+    @staticmethod
+    def restore_styles(backup):
+        """
+        set the newest saved style of every table of backup as the
+        default style of its layer, tables without a layer are skipped.
+        returns the names of the restyled tables
+        """
+        style_sources = {}
+        for link in backup.get_chain():
+            for table_name in link.get_manifest().get("styles", []):
+                style_sources[table_name] = link.file_path
+        tables = backup.get_tables()
+        layers = {}
+        for layer in Layer.objects.all():
+            table_name = str(layer.alternate).split(":").pop()
+            if table_name in style_sources and table_name in tables:
+                layers.setdefault(table_name, layer)
+        restored = []
+        for file_path in set(style_sources.values()):
+            with StyleManager(file_path) as stm:
+                for table_name, layer in layers.items():
+                    if style_sources[table_name] != file_path:
+                        continue
+                    gpkg_style = stm.get_style(table_name)
+                    if not gpkg_style:
+                        continue
+                    try:
+                        style = stm.upload_style(
+                            gpkg_style.styleName, gpkg_style.styleSLD,
+                            overwrite=True)
+                        stm.set_default_layer_style(layer.alternate,
+                                                    style.name)
+                        layer.default_style = style
+                        layer.save()
+                        restored.append(table_name)
+                    except Exception as e:
+                        logger.error(
+                            "Failed to restore the style of {}: {}".format(
+                                table_name, e))
+        logger.info("{} styles restored".format(len(restored)))
+        return restored
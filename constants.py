@@ -7,6 +7,15 @@ from cartoview.app_manager.helpers import create_direcotry
 LayerPostgisOptions = namedtuple(
     'LayerPostgisOptions', ['skipfailures', 'overwrite', 'append', 'update'])
 POSTGIS_OPTIONS = LayerPostgisOptions(True, True, False, False)
+# arrow like string column, value i is data[offsets[i]:offsets[i + 1]]
+StringColumn = namedtuple('StringColumn', ['offsets', 'data'])
+BackupLayer = namedtuple('BackupLayer',
+                         ['table_name', 'geom_attr', 'style_name', 'sld_url'])
+# oid and filenode change when a table is recreated or rewritten
+TableStats = namedtuple('TableStats', [
+    'schema', 'name', 'size', 'rows', 'writes', 'oid', 'filenode',
+    'stats_reset'
+])
 
 _temp_dir = os.path.join(
     os.path.dirname(os.path.realpath(__file__)), 'tmp_generator')
@@ -4,23 +4,43 @@ try:
     import osr
 except BaseException:
     from osgeo import ogr, osr
+import hashlib
 import json
 import os
+import shutil
+import socket
+from collections import deque
+from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 from contextlib import contextmanager
+from itertools import chain
 from uuid import uuid4
 
+import requests
+from django.conf import settings
+from esridump import esri2geojson
 from esridump.dumper import EsriDumper
+from esridump.errors import EsriDownloadError
 from geonode.people.models import Profile
 from requests.exceptions import ConnectionError
 
 from ags2sld.handlers import Layer as AgsLayer
 
+from .constants import _downloads_dir
 from .exceptions import EsriException, EsriFeatureLayerException
 from .handlers import DataManager, get_connection
 from .helpers import urljoin
 from .layer_manager import GpkgLayer
-from .publishers import ICON_REL_PATH, GeonodePublisher, GeoserverPublisher
-from .serializers import EsriSerializer
+from .models import (EsriImportCheckpoint, EsriLayerSync, LayerSchema,
+                     ManagerDownload)
+from .geometry_builder import geojson_to_wkb
+from .pools import discard_ogr_source, get_http_session
+from .postgis_loader import PostgisIndexBuilder, ogr_executor, quote_ident
+from .publishers import (GWC_GRIDSETS, ICON_REL_PATH,
+                         POSTGIS_DEFERRED_INDEXES, POSTGIS_MAINTENANCE_WORKERS,
+                         GeonodePublisher, GeoserverPublisher)
+from .serializers import EsriSerializer, metadata_cache
+from .style_manager import StyleManager
 from .utils import SLUGIFIER, get_new_dir
 
 try:
@@ -31,11 +51,324 @@ except ImportError:
 
 logger = get_logger(__name__)
 
+ESRI_FETCH_WORKERS = getattr(settings, 'DATA_MANAGER_ESRI_FETCH_WORKERS', 4)
+ESRI_BATCH_SIZE = getattr(settings, 'DATA_MANAGER_ESRI_BATCH_SIZE', 10000)
+ESRI_GPKG_BATCH_SIZE = getattr(settings, 'DATA_MANAGER_ESRI_GPKG_BATCH_SIZE',
+                               100000)
+# feature: GEOS check per feature, drop/repair: one query after the load
+VALIDITY_FEATURE = 'feature'
+VALIDITY_DROP = 'drop'
+VALIDITY_REPAIR = 'repair'
+VALIDITY_NONE = 'none'
+ESRI_GEOMETRY_VALIDITY = getattr(
+    settings, 'DATA_MANAGER_ESRI_GEOMETRY_VALIDITY', VALIDITY_DROP)
+
 
 class EsriHandler(EsriDumper):
+    """
+    where, envelope ((xmin, ymin, xmax, ymax) in envelope_sr), out_fields
+    and out_sr are applied by the feature service query
+    """
+
+    def __init__(self,
+                 url,
+                 workers=ESRI_FETCH_WORKERS,
+                 where=None,
+                 envelope=None,
+                 envelope_sr=4326,
+                 out_fields=None,
+                 out_sr=None,
+                 **kwargs):
+        kwargs.setdefault('fields', out_fields)
+        kwargs.setdefault('outSR', out_sr)
+        super(EsriHandler, self).__init__(url, **kwargs)
+        self.workers = workers
+        self.where = where
+        self.envelope = envelope
+        self.envelope_sr = envelope_sr
+        self.out_sr = out_sr
+        self.last_committed_oid = None
+        # service state when the last dump started
+        self.schema_hash = None
+        self.edit_date = None
+        # resume the dump after this objectId
+        self.resume_oid = None
+        # holder of the import checkpoints, retries of a task share it
+        self.import_owner = uuid4().hex
+        # upper objectId of the page being read
+        self.page_max = None
+        self._serializer = None
+        # keep-alive connections shared with the metadata requests
+        self.session = get_http_session('esri')
+
+    def _request(self, method, url, **kwargs):
+        if self._proxy:
+            return super(EsriHandler, self)._request(method, url, **kwargs)
+        try:
+            return self.session.request(
+                method, url, timeout=self._http_timeout, **kwargs)
+        except requests.exceptions.SSLError:
+            logger.warning("Retrying {} without SSL verification".format(url))
+            return self.session.request(
+                method, url, timeout=self._http_timeout, verify=False,
+                **kwargs)
+
+    def get_metadata(self):
+        if self._proxy:
+            return super(EsriHandler, self).get_metadata()
+        return metadata_cache.get(
+            self._layer_url,
+            session=self.session,
+            params=self._build_query_args({'f': 'json'}),
+            headers=self._build_headers())
+
+    @property
+    def is_filtered(self):
+        return bool(self.where or self.envelope)
+
+    def get_options(self):
+        # constructor arguments that shape the dumped data
+        return {
+            "where": self.where,
+            "envelope": list(self.envelope) if self.envelope else None,
+            "envelope_sr": self.envelope_sr,
+            "out_fields": self._fields,
+            "out_sr": self.out_sr
+        }
+
+    @staticmethod
+    def clean_options(options):
+        """
+        validate the query options of a request and return them with
+        the envelope as 4 floats and the spatial references as ints.
+        raises EsriException on bad values
+        """
+        cleaned = {}
+        where = options.get("where")
+        if where:
+            if not isinstance(where, str):
+                raise EsriException("where must be a string")
+            cleaned["where"] = where
+        envelope = options.get("envelope")
+        if envelope:
+            if isinstance(envelope, str):
+                try:
+                    envelope = json.loads(envelope)
+                except ValueError:
+                    envelope = envelope.split(',')
+            try:
+                envelope = [float(value) for value in envelope]
+            except (TypeError, ValueError):
+                envelope = None
+            if not envelope or len(envelope) != 4 or \
+                    envelope[0] > envelope[2] or envelope[1] > envelope[3]:
+                raise EsriException(
+                    "envelope must be [xmin, ymin, xmax, ymax]")
+            cleaned["envelope"] = envelope
+        for key in ("envelope_sr", "out_sr"):
+            value = options.get(key)
+            if not value:
+                continue
+            try:
+                value = int(value)
+            except (TypeError, ValueError):
+                raise EsriException("{} must be an EPSG code".format(key))
+            if osr.SpatialReference().ImportFromEPSG(value) != 0:
+                raise EsriException("Unknown EPSG code {}".format(value))
+            cleaned[key] = value
+        out_fields = options.get("out_fields")
+        if out_fields:
+            if isinstance(out_fields, str):
+                out_fields = out_fields.split(',')
+            if not isinstance(out_fields, (list, tuple)) or not all(
+                    isinstance(field, str) and field.strip()
+                    for field in out_fields):
+                raise EsriException("out_fields must be a list of fields")
+            cleaned["out_fields"] = [field.strip() for field in out_fields]
+        return cleaned
+
+    def get_options_hash(self):
+        # imports of the same url only resume with the same options
+        return hashlib.sha1(
+            json.dumps(self.get_options(),
+                       sort_keys=True).encode('utf-8')).hexdigest()
+
+    def _filter_where(self, where='1=1'):
+        if self.where:
+            return '({}) AND ({})'.format(where, self.where)
+        return where
+
+    def _filter_args(self, query_args):
+        if self.envelope:
+            query_args.update({
+                'geometry': ','.join(map(str, self.envelope)),
+                'geometryType': 'esriGeometryEnvelope',
+                'spatialRel': 'esriSpatialRelIntersects',
+                'inSR': self.envelope_sr,
+            })
+        return self._build_query_args(query_args)
+
+    def _out_fields(self):
+        if not self._fields:
+            return '*'
+        fields = list(self._fields)
+        # the objectId is needed to match rows and resume
+        oid_field_name = self._find_oid_field_name(self.get_metadata())
+        if oid_field_name and oid_field_name not in fields:
+            fields.append(oid_field_name)
+        return ','.join(fields)
+
+    def _page_query_args(self, oid_field_name, page_min, page_max):
+        return self._filter_args({
+            'where': self._filter_where('{} > {} AND {} <= {}'.format(
+                oid_field_name, page_min, oid_field_name, page_max)),
+            'geometryPrecision': self._precision,
+            'returnGeometry': self._request_geometry,
+            'outSR': self._outSR,
+            'outFields': self._out_fields(),
+            'f': 'json',
+        })
+
+    def get_oids(self, where='1=1'):
+        query_args = self._filter_args({
+            'where': self._filter_where(where),
+            'returnIdsOnly': 'true',
+            'f': 'json',
+        })
+        try:
+            response = self._request(
+                'POST', self._build_url('/query'),
+                headers=self._build_headers(), data=query_args)
+            data = self._handle_esri_errors(
+                response, "Could not retrieve object IDs")
+        except EsriDownloadError:
+            raise
+        except Exception as e:
+            raise EsriDownloadError("Could not retrieve object IDs", e)
+        return [int(oid) for oid in data.get('objectIds') or []]
+
+    def build_objectid_pages(self, oids, page_size):
+        # pages of explicit objectIds as (page_max, query_args)
+        oids = sorted(oids)
+        pages = []
+        for i in range(0, len(oids), page_size):
+            chunk = oids[i:i + page_size]
+            pages.append((chunk[-1], self._build_query_args({
+                'objectIds': ','.join(map(str, chunk)),
+                'geometryPrecision': self._precision,
+                'returnGeometry': self._request_geometry,
+                'outSR': self._outSR,
+                'outFields': self._out_fields(),
+                'f': 'json',
+            })))
+        return pages
+
+    def build_oid_pages(self, metadata=None, start_oid=None):
+        """
+        split the service into objectId ranges as (page_max, query_args)
+        after start_oid, returns None when the service can not be split
+        by objectId
+        """
+        metadata = metadata or self.get_metadata()
+        page_size = min(1000, metadata.get('maxRecordCount', 500))
+        oid_field_name = self._find_oid_field_name(metadata)
+        if not oid_field_name:
+            return None
+        if metadata.get('supportsStatistics'):
+            try:
+                oid_min, oid_max = self._get_layer_min_max(oid_field_name)
+                if start_oid is not None:
+                    oid_min = max(oid_min, start_oid + 1)
+                pages = []
+                for page_min in range(oid_min - 1, oid_max, page_size):
+                    page_max = min(page_min + page_size, oid_max)
+                    pages.append((page_max,
+                                  self._page_query_args(
+                                      oid_field_name, page_min, page_max)))
+                return pages
+            except EsriDownloadError as e:
+                logger.warning(e)
+        try:
+            oids = sorted(map(int, self._get_layer_oids()))
+        except EsriDownloadError as e:
+            logger.warning(e)
+            return None
+        if start_oid is not None:
+            oids = [oid for oid in oids if oid > start_oid]
+        pages = []
+        for i in range(0, len(oids), page_size):
+            page_max = oids[min(i + page_size, len(oids)) - 1]
+            pages.append((page_max,
+                          self._page_query_args(oid_field_name, oids[i] - 1,
+                                                page_max)))
+        return pages
+
+    def fetch_page(self, query_args):
+        query_url = self._build_url('/query')
+        headers = self._build_headers()
+        try:
+            response = self._request(
+                'POST', query_url, headers=headers, data=query_args)
+            data = self._handle_esri_errors(
+                response, "Could not retrieve this chunk of objects")
+        except socket.timeout as e:
+            raise EsriDownloadError("Timeout when connecting to URL", e)
+        except ValueError as e:
+            raise EsriDownloadError("Could not parse JSON", e)
+        except EsriDownloadError:
+            raise
+        except Exception as e:
+            raise EsriDownloadError("Could not connect to URL", e)
+        return data.get('features', [])
+
+    def iter_pages(self, pages):
+        # pages are fetched concurrently but yielded in order
+        # with at most 2 pages per worker in memory
+        pages = iter(pages)
+
+        def submit(executor, page):
+            page_max, query_args = page
+            return page_max, executor.submit(self.fetch_page, query_args)
+
+        with ThreadPoolExecutor(max_workers=max(self.workers, 1)) as executor:
+            pending = deque(
+                submit(executor, page)
+                for _, page in zip(range(self.workers * 2), pages))
+            while pending:
+                page_max, future = pending.popleft()
+                features = future.result()
+                page = next(pages, None)
+                if page is not None:
+                    pending.append(submit(executor, page))
+                self.page_max = page_max
+                for feature in features:
+                    yield esri2geojson(feature)
+
+    def __iter__(self):
+        self.page_max = None
+        if self.resume_oid is not None:
+            pages = self.build_oid_pages(start_oid=self.resume_oid)
+            if pages is None:
+                # a full dump would duplicate the rows already stored
+                raise EsriDownloadError(
+                    "Could not split {} by objectId to resume".format(
+                        self._layer_url))
+            return self.iter_pages(pages)
+        if self.workers > 1 or self.is_filtered:
+            pages = self.build_oid_pages()
+            if pages is not None:
+                return self.iter_pages(pages)
+            if self.is_filtered:
+                raise EsriException(
+                    "{} can not be filtered without objectIds".format(
+                        self._layer_url))
+        return super(EsriHandler, self).__iter__()
+
     def get_esri_serializer(self):
-        s = EsriSerializer(self._layer_url)
-        return s
+        if not self._serializer:
+            self._serializer = EsriSerializer(
+                self._layer_url, session=self.session, fields=self._fields)
+        return self._serializer
 
     def get_geom_coords(self, geom_dict):
         if "rings" in geom_dict:
@@ -46,7 +379,18 @@ class EsriHandler(EsriDumper):
         else:
             return geom_dict["coordinates"]
 
-    def create_feature(self, layer, featureDict, expected_type, srs=None):
+    def create_feature(self,
+                       layer,
+                       featureDict,
+                       expected_type,
+                       validate=True,
+                       field_map=None,
+                       oid_field=None,
+                       strict=False):
+        """
+        when strict is set failed inserts raise instead of being logged,
+        features without a usable geometry are skipped either way
+        """
         try:
             geom_dict = featureDict["geometry"]
             if not geom_dict:
@@ -54,24 +398,123 @@ class EsriHandler(EsriDumper):
             geom_type = geom_dict["type"]
             feature = ogr.Feature(layer.GetLayerDefn())
             coords = self.get_geom_coords(geom_dict)
-            f_json = json.dumps({"type": geom_type, "coordinates": coords})
-            geom = ogr.CreateGeometryFromJson(f_json)
-            if geom and srs:
-                geom.Transform(srs)
+            geom = ogr.CreateGeometryFromWkb(
+                geojson_to_wkb(geom_type, coords))
             if geom and expected_type != geom.GetGeometryType():
                 geom = ogr.ForceTo(geom, expected_type)
-            if geom and expected_type == geom.GetGeometryType(
-            ) and geom.IsValid():
+            if geom and expected_type == geom.GetGeometryType() and (
+                    not validate or geom.IsValid()):
                 feature.SetGeometry(geom)
+                # the objectId is the fid so later syncs can match rows
+                oid = featureDict["properties"].get(oid_field) \
+                    if oid_field else None
+                if oid is not None:
+                    feature.SetFID(int(oid))
+                if field_map is None:
+                    field_map = self.get_field_map(
+                        layer.GetLayerDefn(),
+                        dict((name, str(SLUGIFIER(name)))
+                             for name in featureDict["properties"]))
                 for prop, val in featureDict["properties"].items():
-                    name = str(SLUGIFIER(prop)).encode('utf-8')
-                    value = val
-                    if value and layer.GetLayerDefn().GetFieldIndex(name) != -1:
-                        feature.SetField(name, value)
-                layer.CreateFeature(feature)
+                    idx = field_map.get(prop)
+                    if idx is not None and val is not None:
+                        feature.SetField(idx, val)
+                if layer.CreateFeature(feature) != ogr.OGRERR_NONE:
+                    raise EsriException("Failed to write feature {}".format(
+                        featureDict.get("id")))
+        except EsriFeatureLayerException as e:
+            logger.error(e)
         except Exception as e:
+            # a failed insert aborts the whole postgres transaction
+            if strict:
+                raise
             logger.error(e)
 
+    @staticmethod
+    def get_field_map(layer_defn, columns):
+        # esri field name -> ogr field index, skipping unknown fields
+        field_map = {}
+        for name, column in columns.items():
+            idx = layer_defn.GetFieldIndex(column)
+            if idx != -1:
+                field_map[name] = idx
+        return field_map
+
+    def write_features(self,
+                       layer,
+                       features,
+                       gtype,
+                       validate=True,
+                       field_map=None,
+                       batch_size=ESRI_BATCH_SIZE,
+                       on_commit=None,
+                       oid_field=None):
+        """
+        write features committing about every batch_size features.
+        when pages come by objectId ranges commits happen on page
+        boundaries and self.last_committed_oid is the upper objectId
+        of the last committed page, on_commit(last_committed_oid) is
+        called after every successful commit.
+        failed inserts raise, a failed insert aborts the postgres
+        transaction and its commit would silently roll the batch back
+        """
+        count = pending = 0
+        last_page = None
+
+        def commit():
+            # the transaction is over whatever the result
+            state["open"] = False
+            if layer.CommitTransaction() != ogr.OGRERR_NONE:
+                raise EsriException(
+                    "Failed to commit the features after objectId {}".format(
+                        self.last_committed_oid))
+            self.last_committed_oid = last_page
+            logger.info("{} features committed".format(count))
+            if on_commit:
+                on_commit(last_page)
+
+        state = {"open": True}
+        layer.StartTransaction()
+        try:
+            for feature in features:
+                page = self.page_max
+                if pending >= batch_size and (page is None
+                                              or page != last_page):
+                    commit()
+                    pending = 0
+                    layer.StartTransaction()
+                    state["open"] = True
+                last_page = page
+                self.create_feature(
+                    layer, feature, gtype, validate=validate,
+                    field_map=field_map, oid_field=oid_field, strict=True)
+                pending += 1
+                count += 1
+            commit()
+        except BaseException:
+            if state["open"]:
+                layer.RollbackTransaction()
+            raise
+        return count
+
+    @staticmethod
+    def apply_validity(source, table, geom_column, policy):
+        # check the whole table at once in postgis instead of
+        # running a GEOS validity check for every feature
+        if policy not in (VALIDITY_DROP, VALIDITY_REPAIR) or not geom_column:
+            return
+        table = quote_ident(table)
+        geom_column = quote_ident(geom_column)
+        execute = ogr_executor(source)
+        if policy == VALIDITY_REPAIR:
+            # repairs that change the geometry type do not fit the column
+            execute("UPDATE {0} SET {1} = ST_MakeValid({1}) \
+                WHERE NOT ST_IsValid({1}) AND \
+                GeometryType(ST_MakeValid({1})) = GeometryType({1})".format(
+                table, geom_column))
+        execute("DELETE FROM {} WHERE NOT ST_IsValid({})".format(
+            table, geom_column))
+
     def _unique_name(self, name):
         if len(name) > 63:
             name = name[:63]
@@ -96,68 +539,290 @@ class EsriHandler(EsriDumper):
         yield layer
         layer = None
 
+    @contextmanager
+    def existing_source_layer(self, layer):
+        yield layer
+        layer = None
+
+    def get_output_projection(self, es):
+        """
+        projection of the dumped features, the service reprojects them
+        to out_sr or to its own projection so features are written as is
+        """
+        projection = es.get_projection()
+        if self.out_sr:
+            projection = osr.SpatialReference()
+            if projection.ImportFromEPSG(int(self.out_sr)) != 0:
+                raise EsriException("Unknown EPSG code {}".format(
+                    self.out_sr))
+        self._outSR = str(projection.GetAuthorityCode(None) or 4326)
+        return projection
+
     def esri_to_postgis(self,
                         overwrite=False,
                         temporary=False,
                         launder=False,
                         name=None,
-                        geom_name='geom'):
+                        geom_name='geom',
+                        deferred_indexes=False,
+                        maintenance_workers=None,
+                        geometry_validity=ESRI_GEOMETRY_VALIDITY,
+                        batch_size=ESRI_BATCH_SIZE,
+                        resumable=False):
+        """
+        dump the service into a postgis table.
+        when resumable is set a checkpoint is saved after every committed
+        batch and an import of the same url continues from the last
+        checkpoint into the same table.
+        download errors are raised after the checkpoint is saved
+        """
         gpkg_layer = None
+        validate = geometry_validity == VALIDITY_FEATURE
         try:
             es = self.get_esri_serializer()
-            if not name:
-                name = self.get_new_name(es.get_name())
-            feature_iter = iter(self)
-            first_feature = next(feature_iter)
-            with DataManager.open_source(get_connection(),
-                                         is_postgres=True) as source:
-                options = [
-                    'OVERWRITE={}'.format("YES" if overwrite else 'NO'),
-                    'TEMPORARY={}'.format("OFF" if not temporary else "ON"),
-                    'LAUNDER={}'.format("YES" if launder else "NO"),
-                    'GEOMETRY_NAME={}'.format(
-                        geom_name if geom_name else 'geom')
-                ]
+            schema_hash = self.schema_hash = es.get_schema_hash()
+            self.edit_date = es.get_last_edit_date()
+            projection = self.get_output_projection(es)
+            options_hash = self.get_options_hash()
+            checkpoint, stale_tables = EsriImportCheckpoint.claim(
+                self._layer_url, options_hash, schema_hash,
+                self.import_owner) if resumable else (None, [])
+            with DataManager.open_source(
+                    get_connection(), is_postgres=True, pooled=True) as source:
+                layer = None
+                resuming = False
+                if stale_tables:
+                    self.drop_tables(source, stale_tables)
+                if checkpoint:
+                    layer = source.GetLayerByName(str(checkpoint.table_name))
+                    if layer:
+                        name = checkpoint.table_name
+                        resuming = True
+                        self.resume_oid = checkpoint.last_oid
+                        logger.info("resuming {} after objectId {}".format(
+                            name, checkpoint.last_oid))
+                    else:
+                        checkpoint.delete()
+                feature_iter = iter(self)
+                if not resuming:
+                    # nothing is created for empty services
+                    feature_iter = chain([next(feature_iter)], feature_iter)
+                    if not name:
+                        name = self.get_new_name(es.get_name())
                 gtype = es.get_geometry_type()
-                coord_trans = None
-                OSR_WGS84_REF = osr.SpatialReference()
-                OSR_WGS84_REF.ImportFromEPSG(4326)
-                projection = es.get_projection()
-                if projection != OSR_WGS84_REF:
-                    coord_trans = osr.CoordinateTransformation(
-                        OSR_WGS84_REF, projection)
-                with self.create_source_layer(source, str(name), projection,
-                                              gtype, options) as layer:
-                    for field in es.build_fields():
-                        layer.CreateField(field)
-                    layer.StartTransaction()
-                    gpkg_layer = GpkgLayer(layer, source)
-                    self.create_feature(layer, first_feature,
-                                        gtype, srs=coord_trans)
-                    for next_feature in feature_iter:
-                        self.create_feature(
-                            layer, next_feature, gtype, srs=coord_trans)
-                    layer.CommitTransaction()
-        except (StopIteration, EsriException, EsriFeatureLayerException,
-                ConnectionError) as e:
+                if resuming:
+                    layer_context = self.existing_source_layer(layer)
+                else:
+                    options = [
+                        'OVERWRITE={}'.format("YES" if overwrite else 'NO'),
+                        'TEMPORARY={}'.format(
+                            "OFF" if not temporary else "ON"),
+                        'LAUNDER={}'.format("YES" if launder else "NO"),
+                        'GEOMETRY_NAME={}'.format(
+                            geom_name if geom_name else 'geom')
+                    ]
+                    if deferred_indexes:
+                        options.append('SPATIAL_INDEX=NO')
+                    layer_context = self.create_source_layer(
+                        source, str(name), projection, gtype, options)
+                    discard_ogr_source(get_connection(), source)
+                with layer_context as layer:
+                    # tables of failed imports without a checkpoint are
+                    # dropped so a retry can create them again
+                    checkpointed = [resuming]
+                    try:
+                        if not resuming:
+                            for field in es.build_fields():
+                                layer.CreateField(field)
+                        indexes = None
+                        if deferred_indexes:
+                            # force the deferred table creation
+                            layer.SyncToDisk()
+                            indexes = PostgisIndexBuilder(
+                                ogr_executor(source),
+                                layer.GetName(),
+                                fid_column=layer.GetFIDColumn(),
+                                geom_column=layer.GetGeometryColumn(),
+                                maintenance_workers=maintenance_workers)
+                            indexes.drop()
+                        gpkg_layer = GpkgLayer(layer, source)
+                        field_map = self.get_field_map(
+                            layer.GetLayerDefn(),
+                            es.get_field_columns())
+
+                        def save_checkpoint(last_oid):
+                            if resumable and last_oid is not None:
+                                EsriImportCheckpoint.save_progress(
+                                    self._layer_url, options_hash,
+                                    layer.GetName(), schema_hash, last_oid,
+                                    owner=self.import_owner)
+                                checkpointed[0] = True
+
+                        self.write_features(
+                            layer,
+                            feature_iter,
+                            gtype,
+                            validate=validate,
+                            field_map=field_map,
+                            batch_size=batch_size,
+                            on_commit=save_checkpoint,
+                            oid_field=es.get_oid_field_name())
+                        self.apply_validity(source, layer.GetName(),
+                                            layer.GetGeometryColumn(),
+                                            geometry_validity)
+                        if indexes:
+                            indexes.build()
+                        if resumable:
+                            EsriImportCheckpoint.clear(self._layer_url,
+                                                       options_hash,
+                                                       layer.GetName())
+                    except BaseException:
+                        if layer is not None and not checkpointed[0]:
+                            table_name = layer.GetName()
+                            gpkg_layer = layer = None
+                            logger.error("DELETING Table {}".format(
+                                table_name))
+                            source.DeleteLayer(table_name)
+                        raise
+        except (StopIteration, EsriException,
+                EsriFeatureLayerException) as e:
             logger.debug(e)
             if isinstance(e, EsriFeatureLayerException):
                 logger.info(e)
             if isinstance(e, EsriException):
                 layer = None
             logger.error(e)
+            gpkg_layer = None
+        return gpkg_layer
+
+    def dump_sld(self):
+        """
+        dump the service symbology with ags2sld,
+        returns (ags_layer, sld_path or None, icon_paths)
+        """
+        agsURL, agsId = self._layer_url.rsplit('/', 1)
+        tmp_dir = get_new_dir()
+        ags_layer = AgsLayer(agsURL + "/", int(agsId), dump_folder=tmp_dir)
+        try:
+            ags_layer.dump_sld_file()
+        except Exception as e:
+            logger.error(e)
+        sld_path = None
+        icon_paths = []
+        for file in os.listdir(tmp_dir):
+            if file.endswith(".sld"):
+                sld_path = os.path.join(tmp_dir, file)
+        icons_dir = os.path.join(tmp_dir, ags_layer.name)
+        if os.path.exists(icons_dir):
+            for file in os.listdir(icons_dir):
+                if file.endswith(".png") or file.endswith(".svg"):
+                    icon_paths.append(os.path.join(icons_dir, file))
+        return ags_layer, sld_path, icon_paths
+
+    def esri_to_gpkg(self,
+                     path,
+                     name=None,
+                     geom_name='geom',
+                     batch_size=ESRI_GPKG_BATCH_SIZE):
+        """
+        stream the service into a new geopackage at path without
+        touching postgis, returns (layer name, geometry column).
+        the geopackage is removed when the dump fails
+        """
+        es = self.get_esri_serializer()
+        name = str(name or es.get_name())
+        projection = self.get_output_projection(es)
+        feature_iter = iter(self)
+        # nothing is created for empty services
+        try:
+            feature_iter = chain([next(feature_iter)], feature_iter)
+        except StopIteration:
+            raise EsriException("{} has no features".format(self._layer_url))
+        gtype = es.get_geometry_type()
+        source = ogr.GetDriverByName("GPKG").CreateDataSource(path)
+        if not source:
+            raise EsriException("Cannot create {}".format(path))
+        try:
+            layer = source.CreateLayer(
+                name, srs=projection, geom_type=gtype,
+                options=['GEOMETRY_NAME={}'.format(geom_name)])
+            for field in es.build_fields():
+                layer.CreateField(field)
+            self.write_features(
+                layer,
+                feature_iter,
+                gtype,
+                validate=ESRI_GEOMETRY_VALIDITY != VALIDITY_NONE,
+                field_map=self.get_field_map(layer.GetLayerDefn(),
+                                             es.get_field_columns()),
+                batch_size=batch_size,
+                oid_field=es.get_oid_field_name())
+            geom_column = layer.GetGeometryColumn()
+            layer = None
+        except BaseException:
+            layer = source = None
+            self.remove_gpkg(path)
+            raise
         finally:
-            return gpkg_layer
+            source = None
+        return name, geom_column
+
+    @staticmethod
+    def remove_gpkg(path):
+        for file_path in (path, path + '-journal', path + '-wal',
+                          path + '-shm'):
+            if os.path.exists(file_path):
+                os.remove(file_path)
+
+    def export_download(self, user, file_name=None):
+        """
+        dump the service and its style to a geopackage download of user
+        """
+        es = self.get_esri_serializer()
+        file_name = os.path.basename(file_name or es.get_name())
+        if not file_name.endswith(".gpkg"):
+            file_name += ".gpkg"
+        download_dir = get_new_dir(base_dir=_downloads_dir)
+        file_path = os.path.join(download_dir, file_name)
+        # the download only appears under its name once it is complete
+        tmp_path = os.path.join(download_dir,
+                                ".{}.gpkg".format(uuid4().hex))
+        try:
+            name, geom_column = self.esri_to_gpkg(tmp_path)
+            ags_layer, sld_path, _ = self.dump_sld()
+            if sld_path:
+                with open(sld_path, 'r') as sld_file:
+                    sld_body = sld_file.read()
+                with StyleManager(tmp_path) as stm:
+                    stm.create_table()
+                    stm.add_style(name, geom_column,
+                                  SLUGIFIER(ags_layer.name), sld_body,
+                                  default=True)
+            os.rename(tmp_path, file_path)
+        except BaseException:
+            shutil.rmtree(download_dir, ignore_errors=True)
+            raise
+        return ManagerDownload.objects.create(user=user, file_path=file_path)
 
     def publish(self,
                 overwrite=False,
                 temporary=False,
                 launder=False,
-                name=None):
+                name=None,
+                resumable=False,
+                deferred_indexes=POSTGIS_DEFERRED_INDEXES,
+                maintenance_workers=POSTGIS_MAINTENANCE_WORKERS):
+        geonode_layer = None
         try:
-            geonode_layer = None
             user = Profile.objects.filter(is_superuser=True).first()
-            layer = self.esri_to_postgis(overwrite, temporary, launder, name)
+            layer = self.esri_to_postgis(
+                overwrite,
+                temporary,
+                launder,
+                name,
+                deferred_indexes=deferred_indexes,
+                maintenance_workers=maintenance_workers,
+                resumable=resumable)
             if not layer:
                 raise Exception("failed to dump layer")
             gs_layername = layer.get_new_name()
@@ -166,36 +831,14 @@ class EsriHandler(EsriDumper):
             published = gs_pub.publish_postgis_layer(
                 gs_layername, layername=gs_layername)
             if published:
-                agsURL, agsId = self._layer_url.rsplit('/', 1)
-                tmp_dir = get_new_dir()
-                ags_layer = AgsLayer(
-                    agsURL + "/", int(agsId), dump_folder=tmp_dir)
-                try:
-                    ags_layer.dump_sld_file()
-                except Exception as e:
-                    logger.error(e)
-                sld_path = None
-                icon_paths = []
-                for file in os.listdir(tmp_dir):
-                    if file.endswith(".sld"):
-                        sld_path = os.path.join(tmp_dir, file)
-                icons_dir = os.path.join(tmp_dir, ags_layer.name)
-                if os.path.exists(icons_dir):
-                    for file in os.listdir(icons_dir):
-                        if file.endswith(".png"):
-                            icon_paths.append(
-                                os.path.join(tmp_dir, ags_layer.name, file))
-                        if file.endswith(".svg"):
-                            icon_paths.append(
-                                os.path.join(tmp_dir, ags_layer.name, file))
+                ags_layer, sld_path, icon_paths = self.dump_sld()
                 if len(icon_paths) > 0:
-                    for icon_path in icon_paths:
-                        uploaded = gs_pub.upload_file(
-                            open(icon_path),
-                            rel_path=urljoin(ICON_REL_PATH, ags_layer.name))
-                        if not uploaded:
-                            logger.error("Failed To Upload SLD Icon {}".format(
-                                icon_path))
+                    failures = gs_pub.upload_files(
+                        icon_paths,
+                        rel_path=urljoin(ICON_REL_PATH, ags_layer.name))
+                    for icon_path, error in failures.items():
+                        logger.error("Failed To Upload SLD Icon {}: {}".format(
+                            icon_path, error))
                 if sld_path:
                     sld_body = None
                     with open(sld_path, 'r') as sld_file:
@@ -207,10 +850,181 @@ class EsriHandler(EsriDumper):
 
             geonode_layer = geonode_pub.publish(gs_layername)
             if geonode_layer:
+                LayerSchema.index_tables([layer.name])
+                EsriLayerSync.register(self._layer_url, layer.name,
+                                       geonode_layer.alternate,
+                                       self.schema_hash, self.edit_date,
+                                       options=self.get_options())
                 logger.info(geonode_layer.alternate)
                 gs_pub.remove_cached(geonode_layer.alternate)
 
+        except (EsriDownloadError, ConnectionError):
+            # the caller can retry from the saved checkpoint
+            raise
         except Exception as e:
             logger.error(e)
-        finally:
-            return geonode_layer
+        return geonode_layer
+
+    @staticmethod
+    def drop_tables(source, tables):
+        for table_name in tables:
+            if source.GetLayerByName(str(table_name)):
+                logger.error("DELETING Table {}".format(table_name))
+                source.DeleteLayer(str(table_name))
+        discard_ogr_source(get_connection(), source)
+
+    def abandon_import(self):
+        """
+        drop the unfinished tables of an import that will not be resumed
+        """
+        tables = EsriImportCheckpoint.abandon(self.import_owner)
+        if tables:
+            with DataManager.open_source(
+                    get_connection(), is_postgres=True,
+                    pooled=True) as source:
+                self.drop_tables(source, tables)
+
+    @staticmethod
+    def get_table_fids(source, table, fid_column):
+        result = source.ExecuteSQL("SELECT {} FROM {}".format(
+            quote_ident(fid_column), quote_ident(table)))
+        fids = []
+        if result:
+            feature = result.GetNextFeature()
+            while feature:
+                fids.append(feature.GetField(0))
+                feature = result.GetNextFeature()
+            source.ReleaseResultSet(result)
+        return fids
+
+    @staticmethod
+    def get_bounds(source, table, geom_column, fid_column, fids):
+        """
+        extents of the rows in fids as {srid: (minx, miny, maxx, maxy)}
+        for every gridset srid of the geowebcache
+        """
+        bounds = {}
+        srids = set(srid for srid, _ in GWC_GRIDSETS.values())
+        for i in range(0, len(fids), 1000):
+            chunk = ','.join(str(int(fid)) for fid in fids[i:i + 1000])
+            for srid in srids:
+                result = source.ExecuteSQL(
+                    "SELECT ST_XMin(e), ST_YMin(e), ST_XMax(e), ST_YMax(e) \
+                    FROM (SELECT ST_Extent(ST_Transform({}, {:d})) AS e \
+                    FROM {} WHERE {} IN ({})) AS extent".format(
+                        quote_ident(geom_column), srid, quote_ident(table),
+                        quote_ident(fid_column), chunk))
+                if not result:
+                    continue
+                feature = result.GetNextFeature()
+                if feature and feature.IsFieldSetAndNotNull(0):
+                    bbox = tuple(feature.GetFieldAsDouble(idx)
+                                 for idx in range(4))
+                    old = bounds.get(srid)
+                    if old:
+                        bbox = (min(old[0], bbox[0]), min(old[1], bbox[1]),
+                                max(old[2], bbox[2]), max(old[3], bbox[3]))
+                    bounds[srid] = bbox
+                source.ReleaseResultSet(result)
+        return bounds
+
+    @staticmethod
+    def merge_bounds(bounds, other):
+        for srid, bbox in other.items():
+            old = bounds.get(srid)
+            if old:
+                bbox = (min(old[0], bbox[0]), min(old[1], bbox[1]),
+                        max(old[2], bbox[2]), max(old[3], bbox[3]))
+            bounds[srid] = bbox
+        return bounds
+
+    def get_changed_oids(self, es, state):
+        edit_field = es.get_edit_date_field()
+        if not edit_field or not state.last_edit_date:
+            return set()
+        since = datetime.utcfromtimestamp(state.last_edit_date / 1000.0)
+        return set(self.get_oids(where="{} > TIMESTAMP '{}'".format(
+            edit_field, since.strftime('%Y-%m-%d %H:%M:%S'))))
+
+    def sync(self, state):
+        """
+        apply the service edits since the last sync of state to its table.
+        rows edited since state.last_edit_date (or new objectIds when the
+        service does not track edits) are replaced and rows removed from
+        the service are deleted in one transaction.
+        returns (upserted, deleted, bounds) where bounds are the extents
+        of the affected rows before and after the sync
+        """
+        es = self.get_esri_serializer()
+        if es.get_schema_hash() != state.schema_hash:
+            raise EsriException(
+                "The schema of {} changed, import the layer again".format(
+                    self._layer_url))
+        edit_date = es.get_last_edit_date()
+        if edit_date and state.last_edit_date and \
+                edit_date <= state.last_edit_date:
+            return 0, 0, {}
+        oid_field = es.get_oid_field_name()
+        if not oid_field:
+            raise EsriException("{} has no objectId field".format(
+                self._layer_url))
+        service_oids = set(self.get_oids())
+        changed_oids = self.get_changed_oids(es, state)
+        gtype = es.get_geometry_type()
+        self.get_output_projection(es)
+        page_size = min(1000, es.get_max_record_count())
+        table = str(state.table_name)
+        with DataManager.open_source(
+                get_connection(), is_postgres=True, pooled=True) as source:
+            layer = source.GetLayerByName(table)
+            if not layer:
+                raise EsriException("{} does not exist".format(table))
+            fid_column = layer.GetFIDColumn()
+            geom_column = layer.GetGeometryColumn()
+            stored_oids = set(self.get_table_fids(source, table, fid_column))
+            upserts = sorted((changed_oids & service_oids) |
+                             (service_oids - stored_oids))
+            deletes = sorted(stored_oids - service_oids)
+            removed = sorted((set(upserts) & stored_oids) | set(deletes))
+            field_map = self.get_field_map(
+                layer.GetLayerDefn(),
+                es.get_field_columns())
+            bounds = self.get_bounds(source, table, geom_column, fid_column,
+                                     removed)
+            execute = ogr_executor(source)
+            layer.StartTransaction()
+            try:
+                for i in range(0, len(removed), 1000):
+                    execute("DELETE FROM {} WHERE {} IN ({})".format(
+                        quote_ident(table), quote_ident(fid_column),
+                        ','.join(map(str, removed[i:i + 1000]))))
+                pages = self.build_objectid_pages(upserts, page_size)
+                for feature in self.iter_pages(pages):
+                    self.create_feature(
+                        layer, feature, gtype,
+                        validate=ESRI_GEOMETRY_VALIDITY != VALIDITY_NONE,
+                        field_map=field_map, oid_field=oid_field,
+                        strict=True)
+            except BaseException:
+                layer.RollbackTransaction()
+                raise
+            # a commit of an aborted transaction is a rollback
+            if layer.CommitTransaction() != ogr.OGRERR_NONE:
+                raise EsriException("Failed to commit the sync of {}".format(
+                    table))
+            self.merge_bounds(bounds, self.get_bounds(
+                source, table, geom_column, fid_column, upserts))
+            layer = None
+        state.mark_synced(edit_date)
+        logger.info("{} synced, {} upserted {} deleted".format(
+            table, len(upserts), len(deletes)))
+        return len(upserts), len(deletes), bounds
+
+    def sync_layer(self, state):
+        upserted, deleted, bounds = self.sync(state)
+        if upserted or deleted:
+            gs_pub = GeoserverPublisher()
+            if not bounds or not gs_pub.truncate_cache(state.layer_name,
+                                                       bounds):
+                gs_pub.remove_cached(state.layer_name)
+        return upserted, deleted
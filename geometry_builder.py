@@ -0,0 +1,80 @@
+# -*- coding: utf-8 -*-
+import struct
+import sys
+from array import array
+from itertools import chain
+
+from .exceptions import EsriFeatureLayerException
+
+WKB_TYPES = {
+    "Point": 1,
+    "LineString": 2,
+    "Polygon": 3,
+    "MultiPoint": 4,
+    "MultiLineString": 5,
+    "MultiPolygon": 6,
+}
+# same flag as ogr.wkb25DBit
+WKB_Z_FLAG = 0x80000000
+_LITTLE_ENDIAN = b'\x01'
+
+
+def _header(geom_type, dims):
+    code = WKB_TYPES[geom_type]
+    if dims == 3:
+        code |= WKB_Z_FLAG
+    return _LITTLE_ENDIAN + struct.pack('<I', code)
+
+
+def _points(points, dims):
+    values = array('d', chain.from_iterable(
+        (tuple(point[:dims]) + (0.0, ) * (dims - len(point)))
+        for point in points))
+    if sys.byteorder != 'little':
+        values.byteswap()
+    return struct.pack('<I', len(points)) + values.tobytes()
+
+
+def _rings(rings, dims):
+    return struct.pack('<I', len(rings)) + b''.join(
+        _points(ring, dims) for ring in rings)
+
+
+def _dims(geom_type, coords):
+    # dig to the first position to know if the geometry has Z values
+    depth = {"Point": 0, "LineString": 1, "MultiPoint": 1,
+             "Polygon": 2, "MultiLineString": 2, "MultiPolygon": 3}
+    position = coords
+    for _ in range(depth[geom_type]):
+        if not position:
+            return 2
+        position = position[0]
+    return 3 if len(position) > 2 else 2
+
+
+def geojson_to_wkb(geom_type, coords):
+    """
+    pack geojson coordinates to (2D or 3D) WKB without a JSON round trip
+    """
+    if geom_type not in WKB_TYPES:
+        raise EsriFeatureLayerException(
+            "Unsupported Geometry Type {}".format(geom_type))
+    dims = _dims(geom_type, coords)
+    header = _header(geom_type, dims)
+    if geom_type == "Point":
+        return header + _points([coords], dims)[4:]
+    if geom_type == "LineString":
+        return header + _points(coords, dims)
+    if geom_type == "Polygon":
+        return header + _rings(coords, dims)
+    if geom_type == "MultiPoint":
+        part_header = _header("Point", dims)
+        return header + struct.pack('<I', len(coords)) + b''.join(
+            part_header + _points([point], dims)[4:] for point in coords)
+    if geom_type == "MultiLineString":
+        part_header = _header("LineString", dims)
+        return header + struct.pack('<I', len(coords)) + b''.join(
+            part_header + _points(line, dims) for line in coords)
+    part_header = _header("Polygon", dims)
+    return header + struct.pack('<I', len(coords)) + b''.join(
+        part_header + _rings(polygon, dims) for polygon in coords)
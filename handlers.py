@@ -16,8 +16,9 @@ from .constants import POSTGIS_OPTIONS, _downloads_dir
 from .exceptions import GpkgLayerException
 from .layer_manager import GpkgLayer, SourceException
 from .mixins import DataManagerMixin
-from .style_manager import StyleManager
-from .utils import get_new_dir, get_sld_body
+from .pools import discard_ogr_source, get_ogr_pool
+from .postgis_loader import PostgisCopyLoader
+from .utils import get_new_dir, get_store_schema
 
 logger = get_logger(__name__)
 
@@ -38,14 +39,34 @@ class DataManager(DataManagerMixin):
         glayer = Layer.objects.get(alternate=glayername)
         if not gpkg_layer:
             raise SourceException("Cannot find this layer in Source")
-        geonode_manager = DataManager(get_connection(), is_postgis=True)
-        glayer = geonode_manager.get_layer_by_name(glayername.split(":").pop())
-        if not glayer:
-            raise GpkgLayerException(
-                "Layer {} Cannot be found in Source".format(glayername))
-        check = DataManager.compare_schema(gpkg_layer, glayer, ignore_case)
+        with DataManager.open_source(
+                get_connection(), is_postgres=True, pooled=True) as source:
+            glayer = source.GetLayerByName(glayername.split(":").pop())
+            if not glayer:
+                raise GpkgLayerException(
+                    "Layer {} Cannot be found in Source".format(glayername))
+            check = DataManager.compare_schema(
+                gpkg_layer, GpkgLayer(glayer, source), ignore_case)
         return check
 
+    def check_schema_geonode_many(self,
+                                  layername,
+                                  glayernames,
+                                  ignore_case=False):
+        gpkg_layer = self.get_layer_by_name(layername)
+        if not gpkg_layer:
+            raise SourceException("Cannot find this layer in Source")
+        with DataManager.open_source(
+                get_connection(), is_postgres=True, pooled=True) as source:
+            targets = {}
+            for glayername in glayernames:
+                glayer = source.GetLayerByName(glayername.split(":").pop())
+                if glayer:
+                    targets[glayername] = GpkgLayer(glayer, source)
+            checks = DataManager.compare_schemas(
+                gpkg_layer, list(targets.values()), ignore_case)
+        return dict(zip(targets.keys(), checks))
+
     def layer_exists(self, layername):
         return DataManager.source_layer_exists(self.source, layername)
 
@@ -64,8 +85,8 @@ class DataManager(DataManagerMixin):
     def read_schema(self):
         return self.read_source_schema(self.source)
 
-    def get_features(self):
-        return self.get_layers_features(self.get_layers())
+    def get_features(self, **kwargs):
+        return self.get_layers_features(self.get_layers(), **kwargs)
 
     def _cmd_lyr_postgis(self,
                          gpkg_path,
@@ -99,17 +120,42 @@ class DataManager(DataManagerMixin):
                          overwrite=True,
                          temporary=False,
                          launder=False,
-                         name=None):
-        with self.open_source(connectionString, is_postgres=True) as source:
+                         name=None,
+                         copy=False,
+                         tolerant=False,
+                         deferred_indexes=False,
+                         maintenance_workers=None):
+        if copy:
+            layer = self.get_layer_by_name(layername)
+            assert layer
+            loader = PostgisCopyLoader(
+                connectionString,
+                tolerant=tolerant,
+                maintenance_workers=maintenance_workers,
+                schema=get_store_schema())
+            try:
+                return loader.load(
+                    layer, name=name, overwrite=overwrite,
+                    launder=launder).table
+            finally:
+                # the table was created outside the pooled datasources
+                get_ogr_pool(connectionString).clear()
+        with self.open_source(
+                connectionString, is_postgres=True, pooled=True) as source:
             layer = self.source.GetLayerByName(layername)
             assert layer
             layer = GpkgLayer(layer, source)
-            return layer.copy_to_source(
-                source,
-                overwrite=overwrite,
-                temporary=temporary,
-                launder=launder,
-                name=name)
+            try:
+                return layer.copy_to_source(
+                    source,
+                    overwrite=overwrite,
+                    temporary=temporary,
+                    launder=launder,
+                    name=name,
+                    deferred_indexes=deferred_indexes,
+                    maintenance_workers=maintenance_workers)
+            finally:
+                discard_ogr_source(connectionString, source)
 
     def layer_to_postgis_cmd(self, layername, connectionString, options=None):
         cmd = self._cmd_lyr_postgis(
@@ -125,55 +171,48 @@ class DataManager(DataManagerMixin):
     def postgis_as_gpkg(connectionString, dest_path, layernames=None):
         if not dest_path.endswith(".gpkg"):
             dest_path += ".gpkg"
-        with DataManager.open_source(connectionString, is_postgres=True) as postgis_source:
+        # pooled datasources may hold an outdated layer list
+        # so they are only used for lookups by name
+        with DataManager.open_source(
+                connectionString, is_postgres=True,
+                pooled=bool(layernames)) as postgis_source:
             ds = ogr.GetDriverByName('GPKG').CreateDataSource(dest_path)
-            layers = DataManager.get_source_layers(postgis_source) \
-                if not layernames \
-                else [layer for layer in
-                      DataManager.get_source_layers(postgis_source)
-                      if layer and layer.name in layernames]
+            if not layernames:
+                layers = [layer.gpkg_layer for layer in
+                          DataManager.get_source_layers(postgis_source)]
+            else:
+                layers = [postgis_source.GetLayerByName(layername)
+                          for layername in layernames]
             for lyr in layers:
-                ds.CopyLayer(lyr.gpkg_layer, lyr.name)
+                if lyr:
+                    ds.CopyLayer(lyr, lyr.GetName())
+            ds = None
         return dest_path
 
     @staticmethod
-    def backup_portal(dest_path=None):
+    def backup_portal(dest_path=None, differential=False, progress=None):
+        """
+        progress(event) receives the BackupProgress events of the run
+        """
+        from .backup import BACKUP_MAX_CHAIN, BackupProgress, PortalBackup
+        from .models import BackupManifest
         final_path = None
         if not dest_path:
             dest_path = get_new_dir(base_dir=_downloads_dir)
+        base = BackupManifest.latest(
+            max_chain=BACKUP_MAX_CHAIN) if differential else None
         file_suff = time.strftime("%Y_%m_%d-%H_%M_%S")
+        if base:
+            file_suff += "_diff"
         package_dir = os.path.join(dest_path, "backup_%s.gpkg" % (file_suff))
-        connection_string = get_connection()
         try:
             if not os.path.isdir(dest_path) or not os.access(
                     dest_path, os.W_OK):
                 raise Exception(
                     'maybe destination is not writable or not a directory')
-            with DataManager.open_source(connection_string, is_postgres=True) as ds:
-                if ds:
-                    all_layers = Layer.objects.all()
-                    layer_styles = []
-                    table_names = []
-                    for layer in all_layers:
-                        typename = str(layer.alternate)
-                        table_name = typename.split(":").pop()
-                        if DataManager.source_layer_exists(ds, table_name):
-                            table_names.append(table_name)
-                            gattr = str(
-                                layer.attribute_set.filter(
-                                    attribute_type__contains='gml').first()
-                                .attribute)
-                            layer_style = layer.default_style
-                            sld_url = layer_style.sld_url
-                            style_name = str(layer_style.name)
-                            layer_styles.append((table_name, gattr, style_name,
-                                                 get_sld_body(sld_url)))
-                    DataManager.postgis_as_gpkg(
-                        connection_string, package_dir, layernames=table_names)
-                    stm = StyleManager(package_dir)
-                    stm.create_table()
-                    for style in layer_styles:
-                        stm.add_style(*style, default=True)
+            PortalBackup(
+                get_connection(),
+                progress=BackupProgress(progress)).run(package_dir, base=base)
             final_path = dest_path
 
         except Exception as e:
@@ -1,24 +1,44 @@
 # -*- coding: utf-8 -*-
 import os
+import re
 import shutil
 import zipfile
+from contextlib import contextmanager
 from uuid import uuid4
 
 from geonode.layers.models import Layer
 
 from cartoview.log_handler import get_logger
 
-from .constants import _downloads_dir, _temp_dir
+from .constants import StringColumn, _downloads_dir, _temp_dir
 from .decorators import FORMAT_EXT, ensure_supported_format
-from .exceptions import SourceException
+from .exceptions import GpkgLayerException, SourceException
+from .postgis_loader import (PostgisIndexBuilder, create_unindexed_table,
+                             ogr_executor)
 from .utils import SLUGIFIER, get_new_dir, get_store_schema
 
 try:
     import ogr
 except ImportError:
     from osgeo import ogr
+try:
+    import numpy as np
+except ImportError:
+    np = None
 logger = get_logger(__name__)
 
+POSTGIS_DRIVERS = ('PostgreSQL', 'PostGIS')
+NUMPY_FIELD_TYPES = {
+    ogr.OFTInteger: 'int32',
+    ogr.OFTInteger64: 'int64',
+    ogr.OFTReal: 'float64',
+}
+_DATE_FIELD_TYPES = (ogr.OFTDate, ogr.OFTDateTime)
+_OGR_DATETIME = re.compile(
+    r'^(\d{4})[/-](\d{2})[/-](\d{2})'
+    r'(?:[ T](\d{2}):(\d{2}):(\d{2}(?:\.\d+)?))?'
+    r'(?:([+-])(\d{2}):?(\d{2})?|Z)?$')
+
 
 class GpkgLayer(object):
     def __init__(self, layer, source):
@@ -35,6 +55,14 @@ class GpkgLayer(object):
                   for i in range(self.layer_defn.GetFieldCount())]
         return schema
 
+    def get_fields_size(self):
+        sizes = {}
+        for i in range(self.layer_defn.GetFieldCount()):
+            field_defn = self.layer_defn.GetFieldDefn(i)
+            sizes[field_defn.GetName()] = (field_defn.GetWidth(),
+                                           field_defn.GetPrecision())
+        return sizes
+
     @staticmethod
     def check_geonode_layer(layername):
         layername = layername.lower()
@@ -97,31 +125,81 @@ class GpkgLayer(object):
     def delete(self):
         self.source.DeleteLayer(self.name)
 
+    @staticmethod
+    def is_postgis_source(source):
+        return source.GetDriver().GetName() in POSTGIS_DRIVERS
+
     @property
     def is_postgis(self):
-        name = self.source.GetDriver().GetName()
-        return name in ['PostgreSQL', 'PostGIS']
+        return self.is_postgis_source(self.source)
 
     def copy_to_source(self,
                        dest_source,
                        overwrite=True,
                        temporary=False,
                        launder=False,
-                       name=None):
+                       name=None,
+                       deferred_indexes=False,
+                       maintenance_workers=None):
         options = [
             'OVERWRITE={}'.format("YES" if overwrite else 'NO'),
             'TEMPORARY={}'.format("OFF" if not temporary else "ON"),
             'LAUNDER={}'.format("YES" if launder else "NO"),
         ]
+        schema = None
         if self.is_postgis:
-            options.append('SCHEMA={}'.format(get_store_schema()))
+            schema = get_store_schema()
+            options.append('SCHEMA={}'.format(schema))
         name = self.name if not name else name
         geom_schema = self.geometry_fields_schema()
         if not overwrite and dest_source.GetLayerByName(name):
             name = self.get_new_name()
         if len(geom_schema) > 0:
             options.append('GEOMETRY_NAME={}'.format(geom_schema[0][0]))
-        dest_source.CopyLayer(self.gpkg_layer, name, options)
+        if not (deferred_indexes and self.is_postgis_source(dest_source)):
+            dest_source.CopyLayer(self.gpkg_layer, name, options)
+            return name
+        dest, name, field_map = create_unindexed_table(
+            dest_source,
+            self,
+            name,
+            overwrite=overwrite,
+            temporary=temporary,
+            launder=launder,
+            schema=schema)
+        layer_name = dest.GetName()
+        indexes = PostgisIndexBuilder(
+            ogr_executor(dest_source),
+            name,
+            fid_column=dest.GetFIDColumn(),
+            geom_column=dest.GetGeometryColumn(),
+            maintenance_workers=maintenance_workers,
+            schema=schema)
+        indexes.drop()
+        dest_defn = dest.GetLayerDefn()
+        dest.StartTransaction()
+        try:
+            with self.read_options() as layer:
+                for feature in layer:
+                    dest_feature = ogr.Feature(dest_defn)
+                    # launder renames the fields, map them by index
+                    dest_feature.SetFromWithMap(feature, 1, field_map)
+                    dest_feature.SetFID(feature.GetFID())
+                    if dest.CreateFeature(dest_feature) != ogr.OGRERR_NONE:
+                        raise GpkgLayerException(
+                            "Failed to copy feature {} to {}".format(
+                                feature.GetFID(), name))
+            if dest.CommitTransaction() != ogr.OGRERR_NONE:
+                raise GpkgLayerException(
+                    "Failed to commit the features of {}".format(name))
+        except BaseException:
+            # do not leave a half copied table without its indexes
+            dest.RollbackTransaction()
+            dest = None
+            logger.error("DELETING Table {}".format(layer_name))
+            dest_source.DeleteLayer(layer_name)
+            raise
+        indexes.build()
         return name
 
     def prj_file(self, dest_path):
@@ -199,14 +277,237 @@ class GpkgLayer(object):
     def get_full_schema(self):
         return self.get_none_geom_schema() + self.geometry_fields_schema()
 
-    def get_features(self):
-        # get a feature with GetFeature(featureindex)
-        # this is the one where featureindex may not start at 0
+    @contextmanager
+    def read_options(self,
+                     fields=None,
+                     geometry=True,
+                     spatial_filter=None,
+                     attribute_filter=None):
+        # push projection and filters down to the driver and
+        # restore the layer state when the caller is done reading
+        ignored = []
+        if fields is not None:
+            ignored = [name for name, _, _ in self.get_none_geom_schema()
+                       if name not in fields]
+        if not geometry:
+            ignored.append('OGR_GEOMETRY')
+        if ignored:
+            self.gpkg_layer.SetIgnoredFields(ignored)
+        if isinstance(spatial_filter, (list, tuple)):
+            self.gpkg_layer.SetSpatialFilterRect(*spatial_filter)
+        elif spatial_filter is not None:
+            self.gpkg_layer.SetSpatialFilter(spatial_filter)
+        if attribute_filter:
+            self.gpkg_layer.SetAttributeFilter(attribute_filter)
         self.gpkg_layer.ResetReading()
-        # get a metadata field with GetField('fieldname'/fieldindex)
-        return [{
-            'fid': feature.GetFID(),
-            'metadata_keys': feature.keys(),
-            'metadata_dict': feature.items(),
-            'geometry': feature.geometry()
-        } for feature in self.gpkg_layer]
+        try:
+            yield self.gpkg_layer
+        finally:
+            if ignored:
+                self.gpkg_layer.SetIgnoredFields([])
+            if spatial_filter is not None:
+                self.gpkg_layer.SetSpatialFilter(None)
+            if attribute_filter:
+                self.gpkg_layer.SetAttributeFilter(None)
+            self.gpkg_layer.ResetReading()
+
+    def iter_features(self,
+                      fields=None,
+                      geometry=True,
+                      as_wkb=False,
+                      spatial_filter=None,
+                      attribute_filter=None):
+        """
+        lazily yield features one by one.
+        fields: subset of attribute names to read (None means all)
+        spatial_filter: ogr.Geometry or (minx, miny, maxx, maxy)
+        attribute_filter: OGR SQL where clause
+        """
+        schema = self.get_none_geom_schema()
+        indexes = [(idx, field[0]) for idx, field in enumerate(schema)
+                   if fields is None or field[0] in fields]
+        keys = [name for _, name in indexes]
+        with self.read_options(
+                fields=fields,
+                geometry=geometry,
+                spatial_filter=spatial_filter,
+                attribute_filter=attribute_filter) as layer:
+            feature = layer.GetNextFeature()
+            while feature:
+                geom = None
+                if geometry:
+                    geom = feature.GetGeometryRef()
+                    if geom:
+                        geom = geom.ExportToWkb() if as_wkb else geom.Clone()
+                yield {
+                    'fid': feature.GetFID(),
+                    'metadata_keys': keys,
+                    'metadata_dict': {name: feature.GetField(idx)
+                                      for idx, name in indexes},
+                    'geometry': geom
+                }
+                feature = layer.GetNextFeature()
+
+    def get_features(self, batch_size=1000, **kwargs):
+        """
+        yield lists of at most batch_size features,
+        accepts the same options as iter_features
+        """
+        batch = []
+        for feature in self.iter_features(**kwargs):
+            batch.append(feature)
+            if len(batch) >= batch_size:
+                yield batch
+                batch = []
+        if batch:
+            yield batch
+
+    @staticmethod
+    def _string_column(values):
+        data = bytearray()
+        offsets = np.zeros(len(values) + 1, dtype='int64')
+        for idx, value in enumerate(values):
+            if value is not None and value is not np.ma.masked:
+                if not isinstance(value, bytes):
+                    value = str(value).encode('utf-8')
+                data += value
+            offsets[idx + 1] = len(data)
+        return StringColumn(offsets, bytes(data))
+
+    @staticmethod
+    def _parse_datetime(value):
+        # ogr text (2020/01/31 10:00:00.5+02) to utc milliseconds
+        match = _OGR_DATETIME.match(value) if value else None
+        if not match:
+            return np.datetime64('NaT', 'ms')
+        year, month, day, hour, minute, second, sign, tz_hour, tz_minute = \
+            match.groups()
+        result = np.datetime64('{}-{}-{}'.format(year, month, day), 'ms')
+        if hour:
+            result += np.timedelta64(
+                int(hour) * 3600000 + int(minute) * 60000 +
+                int(round(float(second) * 1000)), 'ms')
+        if sign:
+            offset = (int(tz_hour) * 60 + int(tz_minute or 0)) * 60000
+            result -= np.timedelta64(offset if sign == '+' else -offset,
+                                     'ms')
+        return result
+
+    @staticmethod
+    def _time_text(millis):
+        # same text as ogr GetField for time fields
+        seconds, millis = divmod(int(millis), 1000)
+        text = '{:02d}:{:02d}:{:02d}'.format(seconds // 3600,
+                                             seconds // 60 % 60,
+                                             seconds % 60)
+        return text + ('.{:03d}'.format(millis) if millis else '')
+
+    def _column(self, field_type, values):
+        """
+        one attribute column of a record batch from a list with None
+        for nulls (features) or from a numpy array (arrow stream).
+        numeric fields are numpy arrays, masked when they have nulls,
+        date and datetime fields are utc datetime64[ms] arrays masked
+        the same way and other fields are StringColumn
+        """
+        mask = np.ma.getmaskarray(values) \
+            if isinstance(values, np.ma.MaskedArray) else None
+        is_array = isinstance(values, np.ndarray) and values.dtype != object
+        dtype = NUMPY_FIELD_TYPES.get(field_type)
+        if dtype:
+            if is_array:
+                data = np.ma.getdata(values).astype(dtype)
+            else:
+                mask = np.array([value is None for value in values],
+                                dtype=bool)
+                data = np.array(
+                    [0 if value is None else value for value in values],
+                    dtype=dtype)
+        elif field_type in _DATE_FIELD_TYPES:
+            if is_array and values.dtype.kind == 'M':
+                data = np.ma.getdata(values).astype('datetime64[ms]')
+            else:
+                data = np.array(
+                    [self._parse_datetime(value) for value in values],
+                    dtype='datetime64[ms]')
+            nulls = np.isnat(data)
+            mask = nulls if mask is None else mask | nulls
+        else:
+            if is_array and values.dtype.kind in 'mi':
+                # arrow time values
+                millis = np.ma.getdata(values).astype(
+                    'timedelta64[ms]').astype('int64')
+                values = [None if mask is not None and mask[idx] else
+                          self._time_text(value)
+                          for idx, value in enumerate(millis)]
+            return self._string_column(values)
+        if mask is not None and mask.any():
+            return np.ma.masked_array(data, mask=mask)
+        return data
+
+    @staticmethod
+    def _wkb_column(values):
+        # object array of WKB bytes, None for empty geometries
+        column = np.empty(len(values), dtype=object)
+        column[:] = [bytes(value) if value is not None else None
+                     for value in values]
+        return column
+
+    def _batch_schema(self, fields):
+        schema = [field for field in self.get_none_geom_schema()
+                  if fields is None or field[0] in fields]
+        geom_schema = self.geometry_fields_schema()
+        geom_name = geom_schema[0][0] if geom_schema else 'geometry'
+        return schema, geom_name
+
+    def _columns_from_arrow(self, batch_size, fields, geometry):
+        options = ['MAX_FEATURES_IN_BATCH={}'.format(batch_size),
+                   'USE_MASKED_ARRAYS=YES']
+        schema, geom_name = self._batch_schema(fields)
+        with self.read_options(fields=fields, geometry=geometry) as layer:
+            fid_name = layer.GetFIDColumn() or 'OGC_FID'
+            arrow_geom_name = layer.GetGeometryColumn() or 'wkb_geometry'
+            stream = layer.GetArrowStreamAsNumPy(options=options)
+            for batch in stream:
+                columns = {'fid': np.asarray(batch[fid_name], dtype='int64')}
+                for name, _, field_type in schema:
+                    columns[name] = self._column(field_type, batch[name])
+                if geometry:
+                    columns[geom_name] = self._wkb_column(
+                        batch[arrow_geom_name])
+                yield columns
+
+    def _columns_from_features(self, batch_size, fields, geometry):
+        schema, geom_name = self._batch_schema(fields)
+        for batch in self.get_features(
+                batch_size=batch_size,
+                fields=fields,
+                geometry=geometry,
+                as_wkb=True):
+            columns = {'fid': np.fromiter(
+                (feature['fid'] for feature in batch),
+                dtype='int64', count=len(batch))}
+            for name, _, field_type in schema:
+                columns[name] = self._column(
+                    field_type,
+                    [feature['metadata_dict'][name] for feature in batch])
+            if geometry:
+                columns[geom_name] = self._wkb_column(
+                    [feature['geometry'] for feature in batch])
+            yield columns
+
+    def get_record_batches(self, batch_size=65536, fields=None,
+                           geometry=True):
+        """
+        yield column oriented batches as dicts of column name to values.
+        both readers return the same columns: fid (int64), the requested
+        fields and the geometry as an object array of WKB. numeric fields
+        are numpy arrays, date and datetime fields utc datetime64[ms]
+        arrays, both masked when they have nulls, other fields are
+        StringColumn(offsets, data)
+        """
+        if np is None:
+            raise GpkgLayerException("numpy is required for record batches")
+        if hasattr(self.gpkg_layer, 'GetArrowStreamAsNumPy'):
+            return self._columns_from_arrow(batch_size, fields, geometry)
+        return self._columns_from_features(batch_size, fields, geometry)
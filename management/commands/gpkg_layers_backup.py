@@ -1,20 +1,32 @@
 # -*- coding: utf-8 -*-
 from __future__ import print_function
 
-import multiprocessing
-import os
 import sys
-import time
 
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from geonode.layers.models import Layer
 
-from data_manager.handlers import DataManager, get_connection
-from data_manager.style_manager import StyleManager
-from data_manager.utils import get_sld_body
+from data_manager.handlers import DataManager
 
-backup_process = None
+
+def format_bytes(size):
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return "%.1f%s" % (size, unit)
+        size /= 1024.0
+    return "%.1fTB" % (size)
+
+
+def render_progress(event):
+    eta = event.get('eta')
+    line = "[%s] %s/%s layers, %s rows, %s written, %.0f rows/s, %s/s" % (
+        event['stage'], event['layers_done'], event['layers_total'],
+        event['rows'], format_bytes(event['bytes']),
+        event['rows_per_second'], format_bytes(event['bytes_per_second']))
+    if eta is not None:
+        line += ", ETA %ds" % (eta)
+    sys.stdout.write("\r%s\033[K" % (line))
+    sys.stdout.flush()
 
 
 class Command(BaseCommand):
@@ -27,31 +39,26 @@ class Command(BaseCommand):
             dest='destination',
             default=settings.BASE_DIR,
             help='Location to save geopackage')
+        parser.add_argument(
+            '--differential',
+            action='store_true',
+            dest='differential',
+            default=False,
+            help='Save only the layers changed since the last backup')
 
     def handle(self, *args, **options):
-        global backup_process
         dest_dir = options.get('destination')
+        differential = options.get('differential')
         try:
-            package_dir = None
-
-            def progress():
-                global package_dir
-                package_dir = DataManager.backup_portal(dest_path=dest_dir)
-
-            backup_process = multiprocessing.Process(target=progress)
-            backup_process.start()
-            i = 0
-            while backup_process.is_alive():
-                time.sleep(1)
-                sys.stdout.write(
-                    "\r%s" % ("[" + ("=" * i) + ">]" + "Backup In Progress"))
-                sys.stdout.flush()
-                i += 1
+            package_dir = DataManager.backup_portal(
+                dest_path=dest_dir,
+                differential=differential,
+                progress=render_progress)
+            if not package_dir:
+                raise Exception("see the log for details")
             print(
                 '\n****************** Backup Created ****************** \n%s\n'
                 % (package_dir))
         except Exception as e:
-            if backup_process and backup_process.is_alive():
-                backup_process.terminate()
             print("\nFailed due to %s" % (e))
             print('\n====== Backup Operation Failed :( ======')
@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import print_function
+
+from django.core.management.base import BaseCommand
+
+from data_manager.backup import PortalBackup
+from data_manager.models import BackupManifest
+
+
+class Command(BaseCommand):
+    help = 'Restore the tables of portal layers from a backup and its full \
+backup chain and reapply the saved styles to the existing layers'
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            'backup_id',
+            nargs='?',
+            type=int,
+            help='BackupManifest id, the latest backup by default')
+
+    def handle(self, *args, **options):
+        backup_id = options.get('backup_id')
+        try:
+            if backup_id:
+                backup = BackupManifest.objects.get(pk=backup_id)
+            else:
+                backup = BackupManifest.objects.first()
+            if not backup:
+                raise Exception("No backup found")
+            for link in backup.get_chain():
+                print("%s %s" % ("full" if link.full else "diff",
+                                 link.file_path))
+            restored = PortalBackup().restore(backup)
+            print('\n****************** %s Layers Restored ******************'
+                  % (len(restored)))
+        except Exception as e:
+            print("\nFailed due to %s" % (e))
+            print('\n====== Restore Operation Failed :( ======')
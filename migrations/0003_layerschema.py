@@ -0,0 +1,24 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0002_managerdownload'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='LayerSchema',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('table_name', models.CharField(unique=True, max_length=255)),
+                ('fingerprint', models.CharField(max_length=40, db_index=True)),
+                ('ci_fingerprint', models.CharField(max_length=40, db_index=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+        ),
+    ]
@@ -0,0 +1,27 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0004_esriimportcheckpoint'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='EsriLayerSync',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('url', models.TextField()),
+                ('table_name', models.CharField(unique=True, max_length=255)),
+                ('layer_name', models.CharField(max_length=255, db_index=True)),
+                ('schema_hash', models.CharField(max_length=40)),
+                ('last_edit_date', models.BigIntegerField(null=True, blank=True)),
+                ('last_synced_at', models.DateTimeField(null=True, blank=True)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+            ],
+        ),
+    ]
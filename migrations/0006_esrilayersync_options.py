@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0005_esrilayersync'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esrilayersync',
+            name='options',
+            field=models.TextField(null=True, blank=True),
+        ),
+    ]
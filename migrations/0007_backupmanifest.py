@@ -0,0 +1,29 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0006_esrilayersync_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='BackupManifest',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('file_path', models.TextField()),
+                ('full', models.BooleanField(default=True)),
+                ('manifest', models.TextField()),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('base', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='data_manager.BackupManifest')),
+            ],
+            options={
+                'ordering': ['-created_at'],
+            },
+        ),
+    ]
@@ -0,0 +1,19 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('data_manager', '0007_backupmanifest'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='esriimportcheckpoint',
+            name='options_hash',
+            field=models.CharField(max_length=40, default=''),
+        ),
+    ]
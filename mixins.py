@@ -1,3 +1,4 @@
+import hashlib
 from contextlib import contextmanager
 
 try:
@@ -19,7 +20,12 @@ class DataManagerMixin(object):
 
     @staticmethod
     @contextmanager
-    def open_source(source_path, is_postgres=False):
+    def open_source(source_path, is_postgres=False, pooled=False):
+        if is_postgres and pooled:
+            from .pools import get_ogr_pool
+            with get_ogr_pool(source_path).connection() as source:
+                yield source
+            return
         full_path = "PG: " + source_path if is_postgres else source_path
         source = ogr.Open(full_path)
         yield source
@@ -49,27 +55,74 @@ class DataManagerMixin(object):
         ]
 
     @staticmethod
-    def compare_schema(layer1, layer2, ignore_case=False):
-        schema1 = layer1.get_full_schema()
-        schema2 = layer2.get_full_schema()
-        if ignore_case:
-            schema1 = [(field[0].lower(), field[1], field[2])
-                       for field in layer1.get_full_schema()]
-            schema2 = [(field[0].lower(), field[1], field[2])
-                       for field in layer2.get_full_schema()]
-        schema1.sort(key=lambda field: field[0])
-        schema2.sort(key=lambda field: field[0])
-        new_fields = [field for field in schema1 if field not in schema2]
-        deleted_fields = [field for field in schema2 if field not in schema1]
-        deleted_fields.sort(key=lambda field: field[0])
-        new_fields.sort(key=lambda field: field[0])
+    def schema_fingerprint(schema, ignore_case=False):
+        fields = sorted((field[0].lower() if ignore_case else field[0],
+                         field[1], field[2]) for field in schema)
+        return hashlib.sha1(repr(fields).encode('utf-8')).hexdigest()
+
+    @staticmethod
+    def normalize_schema(layer, ignore_case=False):
+        # name -> (name, type name, type code, (width, precision))
+        sizes = layer.get_fields_size()
+        schema = {}
+        for name, type_name, field_type in layer.get_full_schema():
+            key = name.lower() if ignore_case else name
+            schema[key] = (key, type_name, field_type,
+                           sizes.get(name, (0, 0)))
+        return schema
+
+    @staticmethod
+    def diff_schema(schema1, schema2):
+        def by_name(field):
+            return field[0]
+
+        new_fields = sorted(
+            (field[:3] for name, field in schema1.items()
+             if name not in schema2 or schema2[name][:3] != field[:3]),
+            key=by_name)
+        deleted_fields = sorted(
+            (field[:3] for name, field in schema2.items()
+             if name not in schema1 or schema1[name][:3] != field[:3]),
+            key=by_name)
+        type_changes = []
+        size_changes = []
+        for name in sorted(set(schema1) & set(schema2)):
+            new, old = schema1[name], schema2[name]
+            if new[2] != old[2]:
+                type_changes.append({
+                    "name": name,
+                    "old_type": old[1],
+                    "new_type": new[1]
+                })
+            elif new[3] != old[3]:
+                size_changes.append({
+                    "name": name,
+                    "old_width": old[3][0],
+                    "old_precision": old[3][1],
+                    "new_width": new[3][0],
+                    "new_precision": new[3][1]
+                })
         return {
-            "compatible": schema1 == schema2,
+            "compatible": not new_fields and not deleted_fields,
             "deleted_fields": deleted_fields,
             "new_fields": new_fields,
+            "type_changes": type_changes,
+            "size_changes": size_changes,
         }
 
+    @classmethod
+    def compare_schemas(cls, layer, targets, ignore_case=False):
+        schema = cls.normalize_schema(layer, ignore_case)
+        return [
+            cls.diff_schema(schema, cls.normalize_schema(target, ignore_case))
+            for target in targets
+        ]
+
+    @classmethod
+    def compare_schema(cls, layer1, layer2, ignore_case=False):
+        return cls.compare_schemas(layer1, [layer2], ignore_case)[0]
+
     @staticmethod
-    def get_layers_features(layers):
+    def get_layers_features(layers, **kwargs):
         for lyr in layers:
-            yield lyr.get_features()
+            yield lyr.get_features(**kwargs)
@@ -1,17 +1,28 @@
 # -*- coding: utf-8 -*-
+import json
 import os
 from datetime import datetime
 
-from django.db import models
+from django.conf import settings
+from django.db import models, transaction
 from django.db.models import signals
 from django.dispatch import receiver
 from geonode.people.models import Profile
 from guardian.shortcuts import assign_perm, get_anonymous_user
 from tastypie.models import create_api_key
 from django.utils import timezone
-from .handlers import DataManager
+from .exceptions import GpkgLayerException
+from .handlers import DataManager, GpkgLayer, get_connection
 from .style_manager import StyleManager
 
+SCHEMA_INDEX_TTL = getattr(settings, 'DATA_MANAGER_SCHEMA_INDEX_TTL', 86400)
+# unfinished esri imports older than this are dropped instead of resumed
+ESRI_CHECKPOINT_MAX_AGE = getattr(
+    settings, 'DATA_MANAGER_ESRI_CHECKPOINT_MAX_AGE', 86400)
+# an import without progress for this long loses its checkpoint claim
+ESRI_CHECKPOINT_CLAIM_TIMEOUT = getattr(
+    settings, 'DATA_MANAGER_ESRI_CHECKPOINT_CLAIM_TIMEOUT', 600)
+
 GPKG_PERMISSIONS = (
     ('view_package', 'View Geopackge'),
     ('download_package', 'Download Geopackge'),
@@ -135,3 +146,241 @@ def delete_file_on_delete(sender, instance, **kwargs):
     if instance.expired:
         if os.path.isfile(instance.file_path):
             os.remove(instance.file_path)
+
+
+class LayerSchema(models.Model):
+    """
+    schema fingerprints of the datastore tables used to find
+    compatible layers without reading every table schema
+    """
+    table_name = models.CharField(max_length=255, unique=True)
+    # empty when the table does not exist in the datastore
+    fingerprint = models.CharField(max_length=40, db_index=True)
+    ci_fingerprint = models.CharField(max_length=40, db_index=True)
+    updated_at = models.DateTimeField(auto_now=True, auto_now_add=False)
+
+    def __str__(self):
+        return self.table_name
+
+    @classmethod
+    def index_source_tables(cls, source, tablenames):
+        for tablename in tablenames:
+            layer = source.GetLayerByName(tablename)
+            fingerprint = ci_fingerprint = ''
+            if layer:
+                schema = GpkgLayer(layer, source).get_full_schema()
+                fingerprint = DataManager.schema_fingerprint(schema)
+                ci_fingerprint = DataManager.schema_fingerprint(
+                    schema, ignore_case=True)
+            cls.objects.update_or_create(
+                table_name=tablename,
+                defaults={
+                    "fingerprint": fingerprint,
+                    "ci_fingerprint": ci_fingerprint
+                })
+
+    @classmethod
+    def index_tables(cls, tablenames):
+        with DataManager.open_source(
+                get_connection(), is_postgres=True, pooled=True) as source:
+            cls.index_source_tables(source, tablenames)
+
+    @classmethod
+    def compatible_tables(cls, layer, tablenames, ignore_case=False):
+        expire = timezone.now() - timezone.timedelta(seconds=SCHEMA_INDEX_TTL)
+        fresh = set(
+            cls.objects.filter(
+                table_name__in=tablenames,
+                updated_at__gte=expire).values_list('table_name', flat=True))
+        outdated = [name for name in tablenames if name not in fresh]
+        if outdated:
+            cls.index_tables(outdated)
+        fingerprint = DataManager.schema_fingerprint(
+            layer.get_full_schema(), ignore_case=ignore_case)
+        lookup = 'ci_fingerprint' if ignore_case else 'fingerprint'
+        return set(
+            cls.objects.filter(**{
+                "table_name__in": tablenames,
+                lookup: fingerprint
+            }).values_list('table_name', flat=True))
+
+
+class EsriImportCheckpoint(models.Model):
+    """
+    progress of an unfinished esri import, imports of the same url
+    and query options resume from last_oid into table_name while the
+    service schema is unchanged. owner is the import holding the
+    checkpoint (the celery task id, kept by its retries)
+    """
+    url = models.TextField(null=False, blank=False)
+    # sha1 of the EsriHandler query options
+    options_hash = models.CharField(max_length=40, default='')
+    table_name = models.CharField(max_length=255)
+    schema_hash = models.CharField(max_length=40)
+    last_oid = models.BigIntegerField()
+    owner = models.CharField(max_length=255, blank=True, default='')
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True, auto_now_add=False)
+
+    def __str__(self):
+        return "{} -> {}".format(self.url, self.table_name)
+
+    @classmethod
+    def claim(cls, url, options_hash, schema_hash, owner):
+        """
+        claim the newest resumable checkpoint of url and options for
+        owner, checkpoints of a running import are skipped.
+        returns (checkpoint or None, stale table names), expired
+        checkpoints and outdated ones of a changed service are deleted
+        and their unfinished tables have to be dropped by the caller
+        """
+        now = timezone.now()
+        expire = now - timezone.timedelta(seconds=ESRI_CHECKPOINT_MAX_AGE)
+        claim_expire = now - timezone.timedelta(
+            seconds=ESRI_CHECKPOINT_CLAIM_TIMEOUT)
+        with transaction.atomic():
+            checkpoints = list(
+                cls.objects.select_for_update().filter(
+                    url=url, options_hash=options_hash).order_by(
+                        '-updated_at'))
+            stale = []
+            claimed = None
+            for checkpoint in checkpoints:
+                claimable = checkpoint.owner in ('', owner) or \
+                    checkpoint.updated_at < claim_expire
+                if checkpoint.updated_at < expire or (
+                        claimable and checkpoint.schema_hash != schema_hash):
+                    stale.append(checkpoint)
+                elif claimable and not claimed:
+                    claimed = checkpoint
+            cls.objects.filter(
+                pk__in=[checkpoint.pk for checkpoint in stale]).delete()
+            if claimed:
+                claimed.owner = owner
+                claimed.save(update_fields=['owner', 'updated_at'])
+        return claimed, [checkpoint.table_name for checkpoint in stale]
+
+    @classmethod
+    def save_progress(cls, url, options_hash, table_name, schema_hash,
+                      last_oid, owner=''):
+        cls.objects.update_or_create(
+            url=url,
+            options_hash=options_hash,
+            table_name=table_name,
+            defaults={
+                "schema_hash": schema_hash,
+                "last_oid": last_oid,
+                "owner": owner
+            })
+
+    @classmethod
+    def clear(cls, url, options_hash, table_name):
+        cls.objects.filter(
+            url=url, options_hash=options_hash,
+            table_name=table_name).delete()
+
+    @classmethod
+    def abandon(cls, owner):
+        """
+        delete the checkpoints of an import that gave up,
+        returns the names of its unfinished tables
+        """
+        with transaction.atomic():
+            checkpoints = cls.objects.select_for_update().filter(owner=owner)
+            tables = list(checkpoints.values_list('table_name', flat=True))
+            checkpoints.delete()
+        return tables
+
+
+class EsriLayerSync(models.Model):
+    """
+    esri service of an imported layer, last_edit_date is the
+    editingInfo.lastEditDate of the service (ms) at the last sync
+    """
+    url = models.TextField(null=False, blank=False)
+    table_name = models.CharField(max_length=255, unique=True)
+    layer_name = models.CharField(max_length=255, db_index=True)
+    schema_hash = models.CharField(max_length=40)
+    last_edit_date = models.BigIntegerField(blank=True, null=True)
+    last_synced_at = models.DateTimeField(blank=True, null=True)
+    # json of the EsriHandler query options used by the import
+    options = models.TextField(blank=True, null=True)
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    def __str__(self):
+        return "{} -> {}".format(self.url, self.layer_name)
+
+    @classmethod
+    def register(cls, url, table_name, layer_name, schema_hash,
+                 last_edit_date, options=None):
+        return cls.objects.update_or_create(
+            table_name=table_name,
+            defaults={
+                "url": url,
+                "layer_name": layer_name,
+                "schema_hash": schema_hash,
+                "last_edit_date": last_edit_date,
+                "last_synced_at": timezone.now(),
+                "options": json.dumps(options) if options else None
+            })[0]
+
+    def get_options(self):
+        return json.loads(self.options) if self.options else {}
+
+    def mark_synced(self, last_edit_date):
+        self.last_edit_date = last_edit_date
+        self.last_synced_at = timezone.now()
+        self.save(update_fields=['last_edit_date', 'last_synced_at'])
+
+
+class BackupManifest(models.Model):
+    """
+    portal backup file with the state of every table and style at backup
+    time, differential backups keep their previous backup in base
+    """
+    file_path = models.TextField(null=False, blank=False)
+    base = models.ForeignKey(
+        'self', blank=True, null=True, on_delete=models.SET_NULL)
+    full = models.BooleanField(default=True)
+    manifest = models.TextField()
+    created_at = models.DateTimeField(auto_now=False, auto_now_add=True)
+
+    class Meta:
+        ordering = ['-created_at']
+
+    def __str__(self):
+        return self.file_path
+
+    def get_manifest(self):
+        return json.loads(self.manifest)
+
+    def get_tables(self):
+        return self.get_manifest().get("tables", {})
+
+    def get_chain(self):
+        # oldest first, starting from the full backup
+        chain = [self]
+        while not chain[-1].full:
+            if not chain[-1].base:
+                raise GpkgLayerException(
+                    "The full backup of {} is missing".format(self))
+            chain.append(chain[-1].base)
+        return list(reversed(chain))
+
+    @classmethod
+    def latest(cls, max_chain=None):
+        """
+        latest backup usable as the base of a differential backup
+        """
+        backup = cls.objects.first()
+        if not backup or not os.path.exists(backup.file_path):
+            return None
+        try:
+            chain = backup.get_chain()
+        except GpkgLayerException:
+            return None
+        if not all(os.path.exists(link.file_path) for link in chain):
+            return None
+        if max_chain and len(chain) >= max_chain:
+            return None
+        return backup
@@ -0,0 +1,284 @@
+# -*- coding: utf-8 -*-
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+from django.conf import settings
+
+try:
+    import ogr
+except ImportError:
+    from osgeo import ogr
+
+from cartoview.log_handler import get_logger
+
+logger = get_logger(__name__)
+
+POOL_MAX_SIZE = getattr(settings, 'DATA_MANAGER_POOL_MAX_SIZE', 5)
+POOL_IDLE_TIMEOUT = getattr(settings, 'DATA_MANAGER_POOL_IDLE_TIMEOUT', 300)
+POOL_WAIT_TIMEOUT = getattr(settings, 'DATA_MANAGER_POOL_WAIT_TIMEOUT', 30)
+# ogr caches the table list of a datasource, recycle them regularly
+OGR_POOL_MAX_AGE = getattr(settings, 'DATA_MANAGER_OGR_POOL_MAX_AGE', 60)
+HTTP_POOL_SIZE = getattr(settings, 'DATA_MANAGER_HTTP_POOL_SIZE', 10)
+HTTP_RETRIES = getattr(settings, 'DATA_MANAGER_HTTP_RETRIES', 3)
+
+
+class PoolExhausted(Exception):
+    pass
+
+
+class ConnectionPool(object):
+    """
+    thread safe pool of open connections.
+    factory() opens a connection, validate(conn) is the health check,
+    reset(conn) runs before a connection returns to the pool and
+    close(conn) releases it. with discard_on_error connections used
+    by a block that raised are closed instead of returning to the pool.
+    """
+
+    def __init__(self,
+                 factory,
+                 validate=None,
+                 reset=None,
+                 close=None,
+                 max_size=POOL_MAX_SIZE,
+                 idle_timeout=POOL_IDLE_TIMEOUT,
+                 max_age=None,
+                 wait_timeout=POOL_WAIT_TIMEOUT,
+                 discard_on_error=False):
+        self.factory = factory
+        self.validate = validate
+        self.reset = reset
+        self.close = close
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.max_age = max_age
+        self.wait_timeout = wait_timeout
+        self.discard_on_error = discard_on_error
+        self._lock = threading.Lock()
+        # ids of borrowed connections to close on release
+        self._invalid = set()
+        self._slots = threading.BoundedSemaphore(max_size)
+        # (connection, created_at, last_used)
+        self._idle = []
+
+    def _discard(self, conn):
+        try:
+            if self.close:
+                self.close(conn)
+        except Exception as e:
+            logger.warning(e)
+
+    def _expired(self, created_at, last_used, now):
+        if self.idle_timeout and now - last_used > self.idle_timeout:
+            return True
+        return bool(self.max_age and now - created_at > self.max_age)
+
+    def _is_healthy(self, conn):
+        if not self.validate:
+            return True
+        try:
+            return self.validate(conn)
+        except Exception as e:
+            logger.warning(e)
+            return False
+
+    def evict_idle(self):
+        now = time.time()
+        with self._lock:
+            expired = [item for item in self._idle
+                       if self._expired(item[1], item[2], now)]
+            self._idle = [item for item in self._idle if item not in expired]
+        for conn, _, _ in expired:
+            self._discard(conn)
+
+    def acquire(self):
+        if not self._slots.acquire(timeout=self.wait_timeout):
+            raise PoolExhausted("No free connection in the pool")
+        try:
+            self.evict_idle()
+            while True:
+                with self._lock:
+                    if not self._idle:
+                        break
+                    conn, created_at, _ = self._idle.pop()
+                if self._is_healthy(conn):
+                    return conn, created_at
+                self._discard(conn)
+            return self.factory(), time.time()
+        except BaseException:
+            self._slots.release()
+            raise
+
+    def invalidate(self, conn):
+        """
+        close a borrowed connection on release instead of keeping it
+        """
+        with self._lock:
+            self._invalid.add(id(conn))
+
+    def release(self, conn, created_at):
+        if conn is None:
+            # the factory failed to connect, nothing to keep
+            self._slots.release()
+            return
+        with self._lock:
+            invalid = id(conn) in self._invalid
+            self._invalid.discard(id(conn))
+        if invalid:
+            self._discard(conn)
+            self._slots.release()
+            return
+        try:
+            if self.reset:
+                self.reset(conn)
+            with self._lock:
+                self._idle.append((conn, created_at, time.time()))
+        except Exception as e:
+            logger.warning(e)
+            self._discard(conn)
+        finally:
+            self._slots.release()
+
+    @contextmanager
+    def connection(self):
+        conn, created_at = self.acquire()
+        try:
+            yield conn
+        except BaseException:
+            if self.discard_on_error:
+                self.invalidate(conn)
+            raise
+        finally:
+            self.release(conn, created_at)
+
+    def clear(self):
+        with self._lock:
+            idle, self._idle = self._idle, []
+        for conn, _, _ in idle:
+            self._discard(conn)
+
+
+def _ogr_validate(source):
+    result = source.ExecuteSQL("SELECT 1")
+    if not result:
+        return False
+    source.ReleaseResultSet(result)
+    return True
+
+
+def _ogr_reset(source):
+    # end a transaction left open by the borrower, postgres only warns
+    # when there is none
+    result = source.ExecuteSQL("ROLLBACK")
+    if result:
+        source.ReleaseResultSet(result)
+    source.FlushCache()
+
+
+def _ogr_close(source):
+    source.FlushCache()
+
+
+def _psycopg2_validate(conn):
+    if conn.closed:
+        return False
+    cursor = conn.cursor()
+    cursor.execute("SELECT 1")
+    cursor.fetchone()
+    conn.rollback()
+    return True
+
+
+def _psycopg2_reset(conn):
+    if not conn.closed:
+        conn.rollback()
+
+
+def _psycopg2_close(conn):
+    conn.close()
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+_pools_pid = os.getpid()
+
+
+def _get_pool(key, builder):
+    global _pools, _pools_pid
+    with _pools_lock:
+        # connections must not be shared with forked workers
+        if _pools_pid != os.getpid():
+            _pools = {}
+            _pools_pid = os.getpid()
+        pool = _pools.get(key)
+        if not pool:
+            pool = _pools[key] = builder()
+    return pool
+
+
+def get_ogr_pool(connection_string):
+    def builder():
+        return ConnectionPool(
+            lambda: ogr.Open("PG: " + connection_string),
+            validate=_ogr_validate,
+            reset=_ogr_reset,
+            close=_ogr_close,
+            max_age=OGR_POOL_MAX_AGE,
+            discard_on_error=True)
+
+    return _get_pool(('ogr', connection_string), builder)
+
+
+def discard_ogr_source(connection_string, source):
+    """
+    after DDL (new, replaced or deleted tables) the layer lists of
+    the pooled datasources are outdated, close source on release and
+    drop the idle ones
+    """
+    pool = get_ogr_pool(connection_string)
+    pool.invalidate(source)
+    pool.clear()
+
+
+def get_psycopg2_pool(connection_string):
+    def builder():
+        import psycopg2
+        return ConnectionPool(
+            lambda: psycopg2.connect(connection_string),
+            validate=_psycopg2_validate,
+            reset=_psycopg2_reset,
+            close=_psycopg2_close)
+
+    return _get_pool(('psycopg2', connection_string), builder)
+
+
+def get_http_session(name='default'):
+    """
+    requests session shared by the threads of this process,
+    keeps up to HTTP_POOL_SIZE keep-alive connections per host and
+    retries idempotent requests on connection errors and 5xx answers
+    """
+    def builder():
+        import requests
+        from requests.adapters import HTTPAdapter
+        from requests.packages.urllib3.util.retry import Retry
+        session = requests.Session()
+        retry = Retry(
+            total=HTTP_RETRIES,
+            read=HTTP_RETRIES,
+            connect=HTTP_RETRIES,
+            backoff_factor=0.3,
+            status_forcelist=(500, 502, 503, 504),
+            method_whitelist=frozenset(['GET', 'PUT', 'DELETE', 'HEAD']),
+            raise_on_status=False)
+        adapter = HTTPAdapter(
+            pool_connections=HTTP_POOL_SIZE,
+            pool_maxsize=HTTP_POOL_SIZE,
+            max_retries=retry)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        return session
+
+    return _get_pool(('http', name), builder)
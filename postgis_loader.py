@@ -0,0 +1,408 @@
+# -*- coding: utf-8 -*-
+import binascii
+import struct
+import time
+from collections import namedtuple
+from io import StringIO
+
+try:
+    import ogr
+except ImportError:
+    from osgeo import ogr
+try:
+    import psycopg2
+except ImportError:
+    psycopg2 = None
+
+from cartoview.log_handler import get_logger
+
+from .exceptions import GpkgLayerException
+from .mixins import DataManagerMixin
+
+logger = get_logger(__name__)
+
+LoadStats = namedtuple('LoadStats',
+                       ['table', 'rows', 'rejected', 'seconds',
+                        'rows_per_second'])
+
+_EWKB_SRID_FLAG = 0x20000000
+_COPY_NULL = '\\N'
+_DATE_TYPES = (ogr.OFTDate, ogr.OFTDateTime, ogr.OFTTime)
+# list field type -> (ogr getter, quote the items)
+_LIST_TYPES = {
+    ogr.OFTIntegerList: ('GetFieldAsIntegerList', False),
+    ogr.OFTInteger64List: ('GetFieldAsInteger64List', False),
+    ogr.OFTRealList: ('GetFieldAsDoubleList', False),
+    ogr.OFTStringList: ('GetFieldAsStringList', True),
+}
+
+
+def quote_ident(name):
+    return '"{}"'.format(name.replace('"', '""'))
+
+
+def hex_ewkb(wkb, srid):
+    # ogr default wkb variant uses the same type codes as postgis ewkb
+    # so we only have to add the srid flag and value after the type
+    endian = '<' if wkb[0:1] == b'\x01' else '>'
+    geom_type = struct.unpack(endian + 'I', wkb[1:5])[0]
+    ewkb = wkb[0:1] + struct.pack(endian + 'II', geom_type | _EWKB_SRID_FLAG,
+                                  srid) + wkb[5:]
+    return binascii.hexlify(ewkb).decode('ascii')
+
+
+def quote_literal(value):
+    return "'{}'".format(value.replace("'", "''"))
+
+
+def ogr_executor(source):
+    def execute(sql):
+        result = source.ExecuteSQL(sql)
+        if result:
+            source.ReleaseResultSet(result)
+
+    return execute
+
+
+def array_literal(values, quote=False):
+    if quote:
+        values = ('"{}"'.format(
+            value.replace('\\', '\\\\').replace('"', '\\"'))
+            for value in values)
+    return '{' + ','.join(str(value) for value in values) + '}'
+
+
+def copy_escape(value):
+    return value.replace('\\', '\\\\').replace('\t', '\\t').replace(
+        '\n', '\\n').replace('\r', '\\r')
+
+
+def create_unindexed_table(source,
+                           layer,
+                           name,
+                           overwrite=True,
+                           temporary=False,
+                           launder=False,
+                           schema=None):
+    """
+    create the postgis table of a gpkg layer without its spatial index.
+    returns (ogr layer, table name without the schema, field map), the
+    field map holds the table field index of every layer field, -1 when
+    the field was not created, for SetFromWithMap
+    """
+    options = [
+        'OVERWRITE={}'.format("YES" if overwrite else 'NO'),
+        'TEMPORARY={}'.format("OFF" if not temporary else "ON"),
+        'LAUNDER={}'.format("YES" if launder else "NO"),
+        'SPATIAL_INDEX=NO',
+    ]
+    if schema:
+        options.append('SCHEMA={}'.format(schema))
+    geom_schema = layer.geometry_fields_schema()
+    if len(geom_schema) > 0:
+        options.append('GEOMETRY_NAME={}'.format(geom_schema[0][0]))
+    prefix = "{}.".format(schema) if schema else ""
+    if not overwrite and source.GetLayerByName(prefix + name):
+        name = layer.get_new_name()
+    dest = source.CreateLayer(
+        str(name),
+        srs=layer.gpkg_layer.GetSpatialRef(),
+        geom_type=layer.geometry_type,
+        options=options)
+    if not dest:
+        raise GpkgLayerException("Cannot create table {}".format(name))
+    layer_defn = layer.layer_defn
+    field_map = []
+    for i in range(layer_defn.GetFieldCount()):
+        if dest.CreateField(layer_defn.GetFieldDefn(i)) != ogr.OGRERR_NONE:
+            field_map.append(-1)
+        else:
+            field_map.append(dest.GetLayerDefn().GetFieldCount() - 1)
+    # force the deferred table creation of the postgres driver
+    dest.SyncToDisk()
+    # launder may have changed the name
+    name = dest.GetName()
+    if prefix and name.startswith(prefix):
+        name = name[len(prefix):]
+    return dest, name, field_map
+
+
+class PostgisIndexBuilder(object):
+    """
+    drop the primary key of a freshly created table before a bulk load
+    and build the primary key, spatial index and statistics afterwards.
+    execute is a callable(sql) bound to the target database
+    """
+
+    def __init__(self,
+                 execute,
+                 table,
+                 fid_column=None,
+                 geom_column=None,
+                 maintenance_workers=None,
+                 schema=None):
+        self.execute = execute
+        self.table = table
+        self.schema = schema
+        self.fid_column = fid_column
+        self.geom_column = geom_column
+        self.maintenance_workers = maintenance_workers
+
+    @property
+    def pkey_name(self):
+        # name of the primary key added by build, postgres truncates
+        # the table part of generated constraint names
+        return "{}_pkey".format(self.table[:63 - len("_pkey")])
+
+    @property
+    def qualified_name(self):
+        table = quote_ident(self.table)
+        if self.schema:
+            return "{}.{}".format(quote_ident(self.schema), table)
+        return table
+
+    def drop(self):
+        if self.fid_column:
+            # the driver may not have used the default constraint name
+            self.execute(
+                "DO $$ DECLARE pkey text; BEGIN \
+                SELECT conname INTO pkey FROM pg_constraint \
+                WHERE conrelid = {0}::regclass AND contype = 'p'; \
+                IF pkey IS NOT NULL THEN \
+                EXECUTE format('ALTER TABLE %s DROP CONSTRAINT %I', {0}, \
+                pkey); END IF; END $$".format(
+                    quote_literal(self.qualified_name)))
+
+    def build(self):
+        table = self.qualified_name
+        if self.maintenance_workers:
+            self.execute("SET max_parallel_maintenance_workers = {:d}".format(
+                self.maintenance_workers))
+        if self.fid_column:
+            self.execute("ALTER TABLE {} ADD CONSTRAINT {} \
+                PRIMARY KEY ({})".format(table, quote_ident(self.pkey_name),
+                                         quote_ident(self.fid_column)))
+            self.execute("SELECT setval(pg_get_serial_sequence({}, {}), \
+                coalesce(max({}), 0) + 1, false) FROM {}".format(
+                quote_literal(table), quote_literal(self.fid_column),
+                quote_ident(self.fid_column), table))
+        if self.geom_column:
+            self.execute("CREATE INDEX IF NOT EXISTS {} ON {} \
+                USING GIST ({})".format(
+                quote_ident("{}_{}_geom_idx".format(self.table,
+                                                    self.geom_column)),
+                table, quote_ident(self.geom_column)))
+        self.execute("ANALYZE {}".format(table))
+
+
+class PostgisCopyLoader(object):
+    """
+    load a GpkgLayer into postgis with COPY FROM STDIN.
+    rows are committed every batch_size features, when tolerant is set
+    rows that can not be loaded are moved to <table>_rejected instead of
+    aborting the load, otherwise the table is dropped.
+    tables are created in schema or in the current schema
+    """
+    rejected_suffix = '_rejected'
+
+    def __init__(self,
+                 connection_string,
+                 batch_size=50000,
+                 tolerant=False,
+                 maintenance_workers=None,
+                 schema=None):
+        if psycopg2 is None:
+            raise GpkgLayerException("psycopg2 is required for COPY loading")
+        self.connection_string = connection_string
+        self.batch_size = batch_size
+        self.tolerant = tolerant
+        self.maintenance_workers = maintenance_workers
+        self.schema = schema
+
+    def qualify(self, table):
+        if self.schema:
+            return "{}.{}".format(quote_ident(self.schema), quote_ident(table))
+        return quote_ident(table)
+
+    def create_table(self, layer, name, overwrite=True, launder=False):
+        with DataManagerMixin.open_source(
+                self.connection_string, is_postgres=True) as source:
+            dest, name, _ = create_unindexed_table(
+                source,
+                layer,
+                name,
+                overwrite=overwrite,
+                launder=launder,
+                schema=self.schema)
+            dest_defn = dest.GetLayerDefn()
+            columns = [dest_defn.GetFieldDefn(i).GetName()
+                       for i in range(dest_defn.GetFieldCount())]
+            fid_column = dest.GetFIDColumn()
+            geom_column = dest.GetGeometryColumn()
+            dest = None
+        return name, fid_column, geom_column, columns
+
+    @staticmethod
+    def _format_datetime(feature, idx, field_type):
+        year, month, day, hour, minute, second, tz = \
+            feature.GetFieldAsDateTime(idx)
+        date = '{:04d}-{:02d}-{:02d}'.format(year, month, day)
+        # truncate the milliseconds, rounding can give 60 seconds
+        millis = min(int((second - int(second)) * 1000), 999)
+        clock = '{:02d}:{:02d}:{:02d}.{:03d}'.format(hour, minute,
+                                                     int(second), millis)
+        if field_type == ogr.OFTDate:
+            return date
+        if tz > 1:
+            offset = (tz - 100) * 15
+            clock += '{}{:02d}:{:02d}'.format('+' if offset >= 0 else '-',
+                                              abs(offset) // 60,
+                                              abs(offset) % 60)
+        if field_type == ogr.OFTTime:
+            return clock
+        return '{} {}'.format(date, clock)
+
+    def serialize(self, feature, field_types, srid, with_fid,
+                  with_geometry):
+        values = [str(feature.GetFID())] if with_fid else []
+        for idx, field_type in enumerate(field_types):
+            if not feature.IsFieldSetAndNotNull(idx):
+                values.append(_COPY_NULL)
+            elif field_type in _DATE_TYPES:
+                values.append(
+                    self._format_datetime(feature, idx, field_type))
+            elif field_type in _LIST_TYPES:
+                getter, quote = _LIST_TYPES[field_type]
+                values.append(copy_escape(array_literal(
+                    getattr(feature, getter)(idx), quote=quote)))
+            elif field_type == ogr.OFTBinary:
+                values.append('\\\\x' + binascii.hexlify(
+                    feature.GetFieldAsBinary(idx)).decode('ascii'))
+            else:
+                values.append(copy_escape(str(feature.GetField(idx))))
+        if with_geometry:
+            geom = feature.GetGeometryRef()
+            values.append(
+                hex_ewkb(geom.ExportToWkb(), srid) if geom else _COPY_NULL)
+        return '\t'.join(values) + '\n'
+
+    def iter_batches(self, layer, srid, with_fid, with_geometry):
+        field_types = [field[2] for field in layer.get_none_geom_schema()]
+        batch = []
+        with layer.read_options(geometry=with_geometry) as ogr_layer:
+            feature = ogr_layer.GetNextFeature()
+            while feature:
+                batch.append((feature.GetFID(),
+                              self.serialize(feature, field_types, srid,
+                                             with_fid, with_geometry)))
+                if len(batch) >= self.batch_size:
+                    yield batch
+                    batch = []
+                feature = ogr_layer.GetNextFeature()
+        if batch:
+            yield batch
+
+    def get_srid(self, cursor, table, geom_column):
+        cursor.execute(
+            "SELECT srid FROM geometry_columns WHERE \
+            f_table_schema=coalesce(%s, current_schema()) \
+            AND f_table_name=%s AND f_geometry_column=%s",
+            (self.schema, table, geom_column))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def create_rejected_table(self, cursor, table):
+        cursor.execute(
+            "CREATE TABLE IF NOT EXISTS {} (fid bigint, row_data text, \
+            error text, rejected_at timestamp DEFAULT now())".format(
+                self.qualify(table + self.rejected_suffix)))
+
+    def copy_rows(self, conn, copy_sql, table, rows):
+        # slow path, isolate the rows that make the batch fail
+        cursor = conn.cursor()
+        self.create_rejected_table(cursor, table)
+        rejected = 0
+        for fid, line in rows:
+            cursor.execute("SAVEPOINT copy_row")
+            try:
+                cursor.copy_expert(copy_sql, StringIO(line))
+                cursor.execute("RELEASE SAVEPOINT copy_row")
+            except psycopg2.Error as e:
+                cursor.execute("ROLLBACK TO SAVEPOINT copy_row")
+                cursor.execute(
+                    "INSERT INTO {} (fid, row_data, error) VALUES \
+                    (%s, %s, %s)".format(
+                        self.qualify(table + self.rejected_suffix)),
+                    (fid, line, str(e)))
+                rejected += 1
+        conn.commit()
+        return len(rows) - rejected, rejected
+
+    def copy_batch(self, conn, copy_sql, table, rows):
+        cursor = conn.cursor()
+        try:
+            cursor.copy_expert(copy_sql,
+                               StringIO(''.join(line for _, line in rows)))
+            conn.commit()
+            return len(rows), 0
+        except psycopg2.Error as e:
+            conn.rollback()
+            if not self.tolerant:
+                raise GpkgLayerException(
+                    "Failed to load {}: {}".format(table, e))
+            logger.warning("batch failed on {}, checking rows: {}".format(
+                table, e))
+            return self.copy_rows(conn, copy_sql, table, rows)
+
+    def load(self, layer, name=None, overwrite=True, launder=False):
+        start = time.time()
+        name, fid_column, geom_column, columns = self.create_table(
+            layer, name or layer.name, overwrite=overwrite, launder=launder)
+        with_geometry = bool(geom_column)
+        copy_columns = ([fid_column] if fid_column else []) + columns
+        if with_geometry:
+            copy_columns.append(geom_column)
+        copy_sql = "COPY {} ({}) FROM STDIN".format(
+            self.qualify(name), ", ".join(map(quote_ident, copy_columns)))
+        rows = rejected = 0
+        conn = psycopg2.connect(self.connection_string)
+        try:
+            cursor = conn.cursor()
+            indexes = PostgisIndexBuilder(
+                cursor.execute,
+                name,
+                fid_column=fid_column,
+                geom_column=geom_column,
+                maintenance_workers=self.maintenance_workers,
+                schema=self.schema)
+            indexes.drop()
+            conn.commit()
+            srid = self.get_srid(cursor, name, geom_column) \
+                if with_geometry else 0
+            for batch in self.iter_batches(layer, srid, bool(fid_column),
+                                           with_geometry):
+                loaded, failed = self.copy_batch(conn, copy_sql, name, batch)
+                rows += loaded
+                rejected += failed
+            indexes.build()
+            conn.commit()
+        except BaseException:
+            # do not leave a half loaded table without its indexes
+            logger.error("DELETING Table {}".format(name))
+            try:
+                conn.rollback()
+                conn.cursor().execute("DROP TABLE IF EXISTS {}".format(
+                    self.qualify(name)))
+                conn.commit()
+            except psycopg2.Error as e:
+                logger.error(e)
+            raise
+        finally:
+            conn.close()
+        seconds = time.time() - start
+        stats = LoadStats(name, rows, rejected, seconds,
+                          rows / seconds if seconds else rows)
+        logger.warning(
+            "{} loaded {} rows ({} rejected) in {:.2f}s, {:.0f} rows/s".format(
+                name, rows, rejected, seconds, stats.rows_per_second))
+        return stats
@@ -1,9 +1,11 @@
 # -*- coding: utf-8 -*-
+import hashlib
 import json
 import os
 import sys
 import time
 import uuid
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from decimal import Decimal
 from io import BytesIO
 
@@ -11,6 +13,7 @@ import lxml
 import requests
 from django.conf import settings
 from django.contrib.gis.geos import Polygon
+from django.db import connection
 from django.utils.translation import ugettext as _
 from geoserver.catalog import FailedRequestError
 
@@ -21,7 +24,11 @@ from geonode.layers.models import Layer
 from geonode.people.models import Profile
 from geonode.security.views import _perms_info_json
 
+from .exceptions import GpkgLayerException
+from .handlers import DataManager, get_connection
 from .helpers import urljoin
+from .models import LayerSchema
+from .pools import get_http_session, get_ogr_pool
 from .utils import SLUGIFIER, create_datastore, requests_retry_session
 
 try:
@@ -32,6 +39,31 @@ logger = get_logger(__name__)
 
 DEFAULT_WORKSPACE = settings.DEFAULT_WORKSPACE
 ICON_REL_PATH = "workspaces/{}/styles".format(DEFAULT_WORKSPACE)
+PUBLISH_STAGES = ('postgis', 'geoserver', 'geonode', 'style', 'done')
+PUBLISH_WORKERS = getattr(settings, 'DATA_MANAGER_PUBLISH_WORKERS', 4)
+POSTGIS_COPY = getattr(settings, 'DATA_MANAGER_POSTGIS_COPY', False)
+POSTGIS_COPY_TOLERANT = getattr(settings, 'DATA_MANAGER_POSTGIS_COPY_TOLERANT',
+                                False)
+POSTGIS_DEFERRED_INDEXES = getattr(
+    settings, 'DATA_MANAGER_POSTGIS_DEFERRED_INDEXES', False)
+POSTGIS_MAINTENANCE_WORKERS = getattr(
+    settings, 'DATA_MANAGER_POSTGIS_MAINTENANCE_WORKERS', None)
+# gridset -> (srid of the gridset bounds, last zoom level)
+GWC_GRIDSETS = getattr(settings, 'DATA_MANAGER_GWC_GRIDSETS', {
+    'EPSG:4326': (4326, 21),
+    'EPSG:900913': (3857, 30),
+})
+GWC_FORMATS = getattr(settings, 'DATA_MANAGER_GWC_FORMATS',
+                      ('image/png', 'image/jpeg'))
+ICON_UPLOAD_WORKERS = getattr(settings, 'DATA_MANAGER_ICON_UPLOAD_WORKERS', 4)
+
+
+def file_md5(path, chunk_size=65536):
+    md5 = hashlib.md5()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            md5.update(chunk)
+    return md5.hexdigest()
 
 
 class GeoserverPublisher(object):
@@ -89,22 +121,105 @@ class GeoserverPublisher(object):
         except Exception as e:
             logger.error(e)
 
+    def get_resource_url(self, rel_path, name=None):
+        if name:
+            return urljoin(self.base_url, "rest/", "resource", rel_path, name)
+        return urljoin(self.base_url, "rest/", "resource", rel_path)
+
     def upload_file(self, file, rel_path=ICON_REL_PATH):
-        url = urljoin(self.base_url, "rest/", "resource", rel_path,
-                      os.path.basename(file.name))
+        url = self.get_resource_url(rel_path, os.path.basename(file.name))
         s = requests.Session()
         s.auth = (self.username, self.password)
         s.headers = {'Content-Type': 'application/octet-stream'}
         s = requests_retry_session(session=s)
-        req = s.put(
-            url,
-            data=file.read(),)
-        message = "URL:{} STATUS:".format(url, req.status_code)
+        # a bytes body is sent again in full on retries
+        req = s.put(url, data=file.read())
+        message = "URL:{} STATUS:{}".format(url, req.status_code)
         logger.error(message)
-        if req.status_code == 201:
+        if req.status_code in (200, 201):
             return True
         return False
 
+    def list_resources(self, rel_path, session=None):
+        session = session or get_http_session('geoserver')
+        req = session.get(
+            self.get_resource_url(rel_path),
+            params={"format": "json"},
+            auth=(self.username, self.password),
+            verify=False)
+        if req.status_code != 200:
+            return set()
+        try:
+            children = req.json()["ResourceDirectory"]["children"]["child"]
+        except (ValueError, KeyError, TypeError):
+            return set()
+        if isinstance(children, dict):
+            children = [children]
+        return set(child["name"] for child in children)
+
+    def is_same_resource(self, session, url, path):
+        # an ETag equal to the md5 spares downloading the resource
+        auth = (self.username, self.password)
+        head = session.head(url, auth=auth, verify=False)
+        if head.status_code != 200:
+            return False
+        md5 = file_md5(path)
+        if head.headers.get('ETag', '').strip('"') == md5:
+            return True
+        current = session.get(url, auth=auth, verify=False)
+        return current.status_code == 200 and \
+            hashlib.md5(current.content).hexdigest() == md5
+
+    def upload_files(self,
+                     paths,
+                     rel_path=ICON_REL_PATH,
+                     max_workers=ICON_UPLOAD_WORKERS):
+        """
+        upload files to the resource directory rel_path concurrently,
+        files that exist on geoserver with the same md5 are skipped.
+        returns {path: error} of the failed uploads
+        """
+        session = get_http_session('geoserver')
+        auth = (self.username, self.password)
+        existing = self.list_resources(rel_path, session=session)
+
+        def upload(path):
+            name = os.path.basename(path)
+            url = self.get_resource_url(rel_path, name)
+            if name in existing and self.is_same_resource(
+                    session, url, path):
+                return False
+            # icons are small, a bytes body can be sent again on retries
+            with open(path, 'rb') as f:
+                data = f.read()
+            req = session.put(
+                url,
+                data=data,
+                auth=auth,
+                headers={'Content-Type': 'application/octet-stream'},
+                verify=False)
+            if req.status_code not in (200, 201):
+                raise GpkgLayerException("URL:{} STATUS:{} {}".format(
+                    url, req.status_code, req.text))
+            return True
+
+        failures = {}
+        uploaded = 0
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = dict(
+                (executor.submit(upload, path), path) for path in paths)
+            for future in as_completed(futures):
+                path = futures[future]
+                try:
+                    uploaded += int(future.result())
+                except Exception as e:
+                    logger.error("Failed To Upload {}: {}".format(path, e))
+                    failures[path] = str(e)
+        logger.info("{} files uploaded, {} unchanged, {} failed".format(
+            uploaded, len(futures) - uploaded - len(failures),
+            len(failures)))
+        return failures
+
     def get_new_style_name(self, sld_name):
         sld_name = SLUGIFIER(sld_name)
         style = gs_catalog.get_style(
@@ -168,6 +283,40 @@ class GeoserverPublisher(object):
         except BaseException as e:
             logger.error(e)
 
+    def truncate_cache(self, typename, bounds):
+        """
+        truncate the cached tiles of typename inside bounds,
+        bounds is {srid: (minx, miny, maxx, maxy)}.
+        returns False when a gridset could not be truncated
+        """
+        s = requests.Session()
+        s.auth = (self.username, self.password)
+        s.headers = {'Content-Type': "application/json"}
+        s = requests_retry_session(session=s)
+        url = urljoin(self.gwc_url, "seed", "{}.json".format(typename))
+        truncated = True
+        for gridset, (srid, zoom_stop) in GWC_GRIDSETS.items():
+            bbox = bounds.get(srid)
+            if not bbox:
+                continue
+            for image_format in GWC_FORMATS:
+                req = s.post(url, json={"seedRequest": {
+                    "name": typename,
+                    "bounds": {"coords": {"double": list(bbox)}},
+                    "srs": {"number": int(gridset.split(':')[-1])},
+                    "gridSetId": gridset,
+                    "zoomStart": 0,
+                    "zoomStop": zoom_stop,
+                    "format": image_format,
+                    "type": "truncate",
+                    "threadCount": 1
+                }}, verify=False)
+                if req.status_code != 200:
+                    logger.error("url: {}, status:{} {}".format(
+                        url, req.status_code, req.text))
+                    truncated = False
+        return truncated
+
 
 class GeonodePublisher(object):
     def __init__(self,
@@ -241,3 +390,167 @@ class GeonodePublisher(object):
             if layer:
                 layer.set_default_permissions()
             return layer
+
+
+class PackageLayerPublisher(object):
+    """
+    publish geopackage layers to postgis, geoserver and geonode.
+    progress is an optional callable(stage, step, total)
+    """
+
+    def __init__(self, manager, style_manager, owner, progress=None):
+        self.manager = manager
+        self.style_manager = style_manager
+        self.owner = owner
+        self.progress = progress
+        self._gs_pub = None
+        self._geonode_pub = None
+
+    @property
+    def gs_pub(self):
+        if not self._gs_pub:
+            self._gs_pub = GeoserverPublisher()
+        return self._gs_pub
+
+    @property
+    def geonode_pub(self):
+        if not self._geonode_pub:
+            self._geonode_pub = GeonodePublisher(owner=self.owner)
+        return self._geonode_pub
+
+    def report(self, stage, step=None, total=None):
+        if self.progress:
+            if step is None:
+                step = PUBLISH_STAGES.index(stage) + 1
+                total = len(PUBLISH_STAGES)
+            self.progress(stage, step, total)
+
+    def load(self, layername, publish_name=None, replace=False,
+             manager=None):
+        """
+        copy the package layer to postgis and return (tablename, gs_layername)
+        """
+        manager = manager or self.manager
+        gs_layername = str(SLUGIFIER(publish_name or layername))
+        package_layer = manager.get_layer_by_name(layername)
+        if not package_layer:
+            raise GpkgLayerException(
+                "Cannot Find {} Layer in This Package".format(layername))
+        if replace:
+            self.gs_pub.delete_layer(gs_layername)
+        tablename = manager.layer_to_postgis(
+            layername,
+            get_connection(),
+            overwrite=replace,
+            name=gs_layername,
+            copy=POSTGIS_COPY,
+            tolerant=POSTGIS_COPY_TOLERANT,
+            deferred_indexes=POSTGIS_DEFERRED_INDEXES,
+            maintenance_workers=POSTGIS_MAINTENANCE_WORKERS)
+        if not publish_name:
+            gs_layername = package_layer.get_new_name()
+        return tablename, gs_layername
+
+    def register(self, layername, tablename, gs_layername, replace=False,
+                 report=True):
+        gs_pub = self.gs_pub
+        try:
+            if report:
+                self.report('geoserver')
+            if not gs_pub.publish_postgis_layer(
+                    tablename, layername=gs_layername):
+                raise Exception("Failed To Publish Layer to Geoserver")
+            if report:
+                self.report('geonode')
+            layer = self.geonode_pub.publish(gs_layername)
+            if not layer:
+                raise Exception("Failed to Publish to Geonode")
+            LayerSchema.index_tables([tablename])
+            if report:
+                self.report('style')
+            stm = self.style_manager
+            gpkg_style = stm.get_style(layername)
+            if gpkg_style:
+                # TODO: handle none default styles
+                style = stm.upload_style(
+                    gpkg_style.styleName, gpkg_style.styleSLD, overwrite=True)
+                stm.set_default_layer_style(layer.alternate, style.name)
+                layer.default_style = style
+                layer.save()
+            if replace:
+                gs_pub.remove_cached(layer.alternate)
+            return layer
+        except Exception as e:
+            logger.error(e)
+            if tablename:
+                logger.error("DELETING Table {} from source".format(tablename))
+                with self.manager.open_source(get_connection(),
+                                              True) as source:
+                    source.DeleteLayer(tablename)
+                get_ogr_pool(get_connection()).clear()
+            if gs_layername and Layer.objects.filter(
+                    alternate__icontains=gs_layername).count() == 0:
+                gs_pub.delete_layer(gs_layername)
+            raise
+
+    def publish(self, layername, publish_name=None, replace=False):
+        self.report('postgis')
+        tablename, gs_layername = self.load(
+            layername, publish_name=publish_name, replace=replace)
+        layer = self.register(
+            layername, tablename, gs_layername, replace=replace)
+        self.report('done')
+        return layer
+
+    def _threaded_load(self, layername):
+        # ogr datasources can not be shared between threads
+        manager = DataManager(self.manager.path, is_postgis=False)
+        try:
+            return self.load(layername, manager=manager)
+        finally:
+            manager = None
+            connection.close()
+
+    def publish_many(self, layernames, max_workers=PUBLISH_WORKERS):
+        """
+        load layers into postgis in parallel then register them
+        in geoserver and geonode, returns a result per layer
+        """
+        total = len(layernames)
+        results = {}
+        loaded = {}
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = {
+                executor.submit(self._threaded_load, layername): layername
+                for layername in layernames
+            }
+            for future in as_completed(futures):
+                layername = futures[future]
+                try:
+                    loaded[layername] = future.result()
+                except Exception as e:
+                    logger.error(e)
+                    results[layername] = {
+                        "status": "failed",
+                        "message": str(e)
+                    }
+                self.report('postgis', len(loaded) + len(results), total)
+        # one package connection for the style lookups of all layers
+        with self.style_manager:
+            for step, layername in enumerate(layernames, 1):
+                if layername in loaded:
+                    tablename, gs_layername = loaded[layername]
+                    try:
+                        layer = self.register(
+                            layername, tablename, gs_layername, report=False)
+                        results[layername] = {
+                            "status": "success",
+                            "alternate": layer.alternate
+                        }
+                    except Exception as e:
+                        results[layername] = {
+                            "status": "failed",
+                            "message": str(e)
+                        }
+                self.report('geonode', step, total)
+        return results
@@ -2,6 +2,7 @@
 import mimetypes
 import os
 from distutils.util import strtobool
+from functools import wraps
 from wsgiref.util import FileWrapper
 
 from celery.result import AsyncResult
@@ -26,15 +27,16 @@ from .auth import ApiKeyPatch
 from .authorization import GpkgAuthorization
 from .constants import _downloads_dir
 from .decorators import FORMAT_EXT, time_it
-from .exceptions import GpkgLayerException
+from .esri_handler import EsriHandler
+from .exceptions import EsriException, GpkgLayerException
 from .handlers import DataManager, GpkgLayer, get_connection
 from .helpers import read_in_chunks
-from .models import GpkgUpload, ManagerDownload
-from .publishers import GeonodePublisher, GeoserverPublisher
+from .models import EsriLayerSync, GpkgUpload, LayerSchema, ManagerDownload
+from .publishers import PackageLayerPublisher
 from .style_manager import StyleManager
-from .tasks import esri_from_url
-from .utils import (SLUGIFIER, _django_connection, _psycopg2, get_geom_attr,
-                    get_sld_body)
+from .tasks import (esri_from_url, esri_sync_layer, esri_to_gpkg_download,
+                    publish_package_layer, publish_package_layers)
+from .utils import get_geom_attr, get_sld_body, postgis_health
 
 logger = get_logger(__name__)
 
@@ -42,13 +44,11 @@ _PERMISSION_MSG_VIEW = ('You don\'t have permissions for this action')
 
 
 def ensure_postgis_connection(func):
+    @wraps(func)
     def wrap(*args, **kwargs):
         this = args[0]
         request = args[1]
-        conn = get_connection()
-        connected = _psycopg2(conn)
-        if not connected:
-            connected = _django_connection()
+        connected = postgis_health.is_connected(get_connection())
         if not connected:
             return this.get_err_response(
                 request, "Cannot Connect To Postgres Please Contact the admin",
@@ -182,6 +182,10 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
                 % (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('publish'),
                 name="api_geopackage_publish"),
+            re_path(r"^(?P<resource_name>%s)/(?P<upload_id>[\d]+)/publish_layers%s$"
+                % (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('publish_layers'),
+                name="api_geopackage_publish_layers"),
             re_path(r"^(?P<resource_name>%s)/permissions%s$" %
                 (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('get_permissions'),
@@ -218,8 +222,22 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
                 (self._meta.resource_name, trailing_slash()),
                 self.wrap_view('esri_dump'),
                 name="api_esri_dump"),
+            re_path(r"^(?P<resource_name>%s)/esri/dump/download%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('esri_download'),
+                name="api_esri_download"),
+            re_path(r"^(?P<resource_name>%s)/esri/sync/layer%s$" %
+                (self._meta.resource_name, trailing_slash()),
+                self.wrap_view('esri_sync'),
+                name="api_esri_sync"),
         ]
 
+    @staticmethod
+    def get_esri_options(data):
+        # query options applied by the feature service,
+        # raises EsriException on bad values
+        return EsriHandler.clean_options(data)
+
     def esri_dump(self, request, **kwargs):
         self.method_check(request, allowed=['post'])
         self.is_authenticated(request)
@@ -227,7 +245,13 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
         data = self.deserialize(request, request.body)
         if 'layer_url' in data:
             layer_url = data.get("layer_url")
-            task = esri_from_url.delay(layer_url, useremail=request.user.email)
+            try:
+                options = self.get_esri_options(data)
+            except EsriException as e:
+                return self.get_err_response(request, str(e),
+                                             http.HttpBadRequest)
+            task = esri_from_url.delay(
+                layer_url, useremail=request.user.email, options=options)
             response_date = {"task_id": task.id}
             return self.create_response(request, response_date,
                                         http.HttpAccepted)
@@ -235,6 +259,52 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
             return self.get_err_response(request, {"layer_url not provided"},
                                          http.HttpBadRequest)
 
+    def esri_download(self, request, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        data = self.deserialize(request, request.body)
+        if 'layer_url' in data:
+            try:
+                options = self.get_esri_options(data)
+            except EsriException as e:
+                return self.get_err_response(request, str(e),
+                                             http.HttpBadRequest)
+            task = esri_to_gpkg_download.delay(
+                data.get("layer_url"),
+                request.user.pk,
+                file_name=data.get("file_name", None),
+                options=options)
+            response_date = {"task_id": task.id}
+            return self.create_response(request, response_date,
+                                        http.HttpAccepted)
+        else:
+            return self.get_err_response(request, {"layer_url not provided"},
+                                         http.HttpBadRequest)
+
+    def esri_sync(self, request, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        data = self.deserialize(request, request.body)
+        layername = data.get("layername", None)
+        if not layername:
+            return self.get_err_response(request, {"layername not provided"},
+                                         http.HttpBadRequest)
+        layer = Layer.objects.filter(alternate=layername).first()
+        if not layer or not request.user.has_perm('change_layer_data',
+                                                  layer):
+            return self.get_err_response(
+                request, {"You are not allowed to change this layer"},
+                http.HttpForbidden)
+        if not EsriLayerSync.objects.filter(layer_name=layername).exists():
+            return self.get_err_response(
+                request, {"This layer was not imported from an esri service"},
+                http.HttpBadRequest)
+        task = esri_sync_layer.delay(layername)
+        response_date = {"task_id": task.id}
+        return self.create_response(request, response_date, http.HttpAccepted)
+
     def task_state(self, request, **kwargs):
         self.method_check(request, allowed=['get'])
         self.is_authenticated(request)
@@ -243,6 +313,8 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
             task_id = request.GET['task_id']
             task = AsyncResult(task_id)
             result = task.result
+            if isinstance(result, Exception):
+                result = str(result)
             state = task.state
             response_date = {"state": state, "result": result}
             return self.create_response(request, response_date,
@@ -321,10 +393,9 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
                 dest_path = DataManager.postgis_as_gpkg(get_connection(),
                                                         file_path,
                                                         layer_names)
-                stm = StyleManager(dest_path)
-                stm.create_table()
-                for style in layer_styles:
-                    stm.add_style(*style, default=True)
+                with StyleManager(dest_path) as stm:
+                    stm.create_table()
+                    stm.add_styles(layer_styles, default=True)
 
                 download_obj = ManagerDownload.objects.create(
                     user=request.user, file_path=file_path)
@@ -428,10 +499,12 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
                     layername, str(layer.alternate)):
                 raise GpkgLayerException("Invalid schema")
             geonode_manager = DataManager(get_connection(), is_postgis=True)
-            gpkg_layer.copy_to_source(
+            table_name = gpkg_layer.copy_to_source(
                 geonode_manager.source,
                 overwrite=True,
                 name=glayername.split(":").pop())
+            LayerSchema.index_source_tables(geonode_manager.source,
+                                            [table_name])
             return self.create_response(
                 request, {"status": "Layer reloaded succesfully"},
                 response_class=http.HttpAccepted)
@@ -456,32 +529,40 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
                 return self.get_err_response(
                     request, "You Don't Have \
                 Permission to View this Package ", http.HttpUnauthorized)
+            gpkg_layer = obj.data_manager.get_layer_by_name(layername)
+            if not gpkg_layer:
+                raise GpkgLayerException(
+                    "No Layer with this name in the package")
+            tables = {
+                str(layer.alternate).split(":").pop(): layer
+                for layer in permitted_layers
+            }
+            compatible = LayerSchema.compatible_tables(
+                gpkg_layer, list(tables.keys()), ignore_case)
             layers = []
-            for layer in permitted_layers:
-                check = obj.data_manager.check_schema_geonode(
-                    layername, str(layer.alternate), ignore_case)
-                if check.get('compatible'):
-                    lyr = {
-                        "name": layer.alternate,
-                        "compatible": check.get('compatible'),
-                        "new_fields": check.get("new_fields", []),
-                        "deleted_fields": check.get("deleted_fields", []),
-                        "urls": {
-                            "reload_url":
-                            request.build_absolute_uri(
-                                reverse(
-                                    'api_reload',
-                                    kwargs={
-                                        "resource_name":
-                                        self._meta.resource_name,
-                                        "upload_id": upload_id,
-                                        "layername": layername,
-                                        "glayername": layer.alternate,
-                                        "api_name": self._meta.api_name
-                                    }))
-                        }
+            for table_name in sorted(compatible):
+                layer = tables[table_name]
+                lyr = {
+                    "name": layer.alternate,
+                    "compatible": True,
+                    "new_fields": [],
+                    "deleted_fields": [],
+                    "urls": {
+                        "reload_url":
+                        request.build_absolute_uri(
+                            reverse(
+                                'api_reload',
+                                kwargs={
+                                    "resource_name":
+                                    self._meta.resource_name,
+                                    "upload_id": upload_id,
+                                    "layername": layername,
+                                    "glayername": layer.alternate,
+                                    "api_name": self._meta.api_name
+                                }))
                     }
-                    layers.append(lyr)
+                }
+                layers.append(lyr)
             data = {"layers": layers}
             return self.create_response(
                 request, data, response_class=http.HttpAccepted)
@@ -521,12 +602,10 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
         self.throttle_check(request)
         replace = str(request.GET.get('replace', False))
         replace = strtobool(replace)
+        run_async = strtobool(str(request.GET.get('async', False)))
         publish_name = request.GET.get('publish_name', None)
         user = request.user
         layername = str(layername)
-        gs_layername = SLUGIFIER(layername) if not publish_name else SLUGIFIER(
-            publish_name)
-        gs_layername = str(gs_layername)
         if publish_name:
             publish_name = str(publish_name)
             permitted = get_objects_for_user(request.user,
@@ -546,72 +625,85 @@ class GpkgUploadResource(MultipartResource, BaseManagerResource):
             return self.get_err_response(request, e, http.HttpNotFound)
         if 'publish_from_package' in get_perms(user, upload):
             manager = upload.data_manager
-            package_layer = manager.get_layer_by_name(layername)
-            if not package_layer:
+            if not manager.layer_exists(layername):
                 return self.get_err_response(
                     request,
                     "Cannot Find {} Layer in This Package".format(layername),
                     http.HttpNotFound)
-
-            conn = get_connection()
-            gs_pub = GeoserverPublisher()
-            if replace:
-                gs_pub.delete_layer(gs_layername)
-            stm = StyleManager(upload.package.path)
-            geonode_pub = GeonodePublisher(owner=request.user)
-            tablename = manager.layer_to_postgis(
-                layername, conn, overwrite=replace, name=gs_layername)
-            if not publish_name:
-                gs_layername = package_layer.get_new_name()
-            geoserver_published = gs_pub.publish_postgis_layer(
-                tablename, layername=gs_layername)
+            if run_async:
+                task = publish_package_layer.delay(
+                    upload.id,
+                    layername,
+                    user.id,
+                    publish_name=publish_name,
+                    replace=replace)
+                return self.create_response(
+                    request, {
+                        "task_id": task.id,
+                        "state_url": self.get_task_state_url(request, task.id)
+                    }, http.HttpAccepted)
+            publisher = PackageLayerPublisher(manager, upload.style_manager,
+                                              user)
             try:
-                if not geoserver_published:
-                    raise Exception("Failed To Publish Layer to Geoserver")
-                layer = geonode_pub.publish(gs_layername)
-                if layer:
-                    gpkg_style = stm.get_style(layername)
-                    if gpkg_style:
-                        # sld_body = stm.convert_sld_attributes(
-                        #     gpkg_style.styleSLD)
-                        sld_body = gpkg_style.styleSLD
-                        name = gpkg_style.styleName
-                        # TODO: handle none default styles
-                        # useDefault = gpkg_style.useAsDefault
-                        style = stm.upload_style(
-                            name, sld_body, overwrite=True)
-                        stm.set_default_layer_style(layer.alternate,
-                                                    style.name)
-                        layer.default_style = style
-                        layer.save()
-                    if replace:
-                        gs_pub.remove_cached(layer.alternate)
-                    return self.create_response(
-                        request, {
-                            "layer_url":
-                            request.build_absolute_uri(
-                                reverse(
-                                    'layer_detail',
-                                    kwargs={
-                                        "layername": layer.alternate,
-                                    }))
-                        },
-                        response_class=http.HttpAccepted)
-                else:
-                    return self.get_err_response(
-                        request, "Failed to Publish to Geonode")
+                layer = publisher.publish(
+                    layername, publish_name=publish_name, replace=replace)
+                return self.create_response(
+                    request, {
+                        "layer_url":
+                        request.build_absolute_uri(
+                            reverse(
+                                'layer_detail',
+                                kwargs={
+                                    "layername": layer.alternate,
+                                }))
+                    },
+                    response_class=http.HttpAccepted)
             except Exception as e:
-                logger.error(e)
-                if tablename:
-                    logger.error(
-                        "DELETING Table {} from source".format(tablename))
-                    with manager.open_source(conn, True) as source:
-                        source.DeleteLayer(tablename)
-                if gs_layername and Layer.objects.filter(
-                        alternate__icontains=gs_layername).count() == 0:
-                    gs_pub.delete_layer(gs_layername)
                 return self.get_err_response(request, e)
 
+    @ensure_postgis_connection
+    def publish_layers(self, request, upload_id, **kwargs):
+        self.method_check(request, allowed=['post'])
+        self.is_authenticated(request)
+        self.throttle_check(request)
+        data = self.deserialize(request, request.body)
+        layernames = data.get('layers', None)
+        if not layernames:
+            return self.get_err_response(
+                request, "please provide layers as a list of layer names",
+                http.HttpBadRequest)
+        layernames = [str(layername) for layername in layernames]
+        try:
+            upload = GpkgUpload.objects.get(pk=upload_id)
+        except GpkgUpload.DoesNotExist as e:
+            return self.get_err_response(request, e, http.HttpNotFound)
+        if 'publish_from_package' not in get_perms(request.user, upload):
+            return self.get_err_response(request, _PERMISSION_MSG_VIEW,
+                                         http.HttpUnauthorized)
+        manager = upload.data_manager
+        missing = [layername for layername in layernames
+                   if not manager.layer_exists(layername)]
+        if missing:
+            return self.get_err_response(
+                request, "Cannot Find {} in This Package".format(
+                    ",".join(missing)), http.HttpNotFound)
+        task = publish_package_layers.delay(upload.id, layernames,
+                                            request.user.id)
+        return self.create_response(
+            request, {
+                "task_id": task.id,
+                "state_url": self.get_task_state_url(request, task.id)
+            }, http.HttpAccepted)
+
+    def get_task_state_url(self, request, task_id):
+        return request.build_absolute_uri("{}?task_id={}".format(
+            reverse(
+                'api_task_state',
+                kwargs={
+                    "resource_name": self._meta.resource_name,
+                    "api_name": self._meta.api_name
+                }), task_id))
+
 
 class ManagerDownloadResource(BaseManagerResource):
     user = fields.ForeignKey(ProfileResource, 'user', full=False, null=True)
@@ -3,10 +3,86 @@ try:
     import osr
 except:
     from osgeo import ogr, osr
-import requests
+import hashlib
+import threading
+import time
+
+from django.conf import settings
+from esridump.errors import EsriDownloadError
+
 from .exceptions import EsriFeatureLayerException
+from .pools import get_http_session
 from .utils import SLUGIFIER
 
+ESRI_METADATA_TTL = getattr(settings, 'DATA_MANAGER_ESRI_METADATA_TTL', 300)
+ESRI_METADATA_CACHE_SIZE = getattr(settings,
+                                   'DATA_MANAGER_ESRI_METADATA_CACHE_SIZE',
+                                   256)
+ESRI_HTTP_TIMEOUT = getattr(settings, 'DATA_MANAGER_ESRI_HTTP_TIMEOUT', 60)
+
+
+class EsriMetadataCache(object):
+    """
+    service metadata (?f=json) by url. entries younger than ttl are
+    served from memory, older ones are revalidated with their ETag
+    """
+
+    def __init__(self, ttl=ESRI_METADATA_TTL,
+                 max_size=ESRI_METADATA_CACHE_SIZE):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        # url -> (data, etag, fetched_at)
+        self._entries = {}
+
+    def _store(self, url, data, etag):
+        with self._lock:
+            if url not in self._entries and \
+                    len(self._entries) >= self.max_size:
+                oldest = min(self._entries,
+                             key=lambda key: self._entries[key][2])
+                del self._entries[oldest]
+            self._entries[url] = (data, etag, time.time())
+
+    def get(self, url, session=None, params=None, headers=None):
+        with self._lock:
+            entry = self._entries.get(url)
+        if entry and time.time() - entry[2] < self.ttl:
+            return entry[0]
+        session = session or get_http_session('esri')
+        headers = dict(headers or {})
+        if entry and entry[1]:
+            headers['If-None-Match'] = entry[1]
+        params = dict(params or {})
+        params['f'] = 'json'
+        response = session.get(
+            url, params=params, headers=headers, timeout=ESRI_HTTP_TIMEOUT)
+        if entry and response.status_code == 304:
+            data, etag = entry[0], entry[1]
+        else:
+            try:
+                data = response.json()
+            except ValueError as e:
+                raise EsriDownloadError(
+                    "Could not parse JSON from {}".format(url), e)
+            if 'error' in data:
+                raise EsriDownloadError(
+                    "Could not retrieve layer metadata: {}".format(
+                        data['error']))
+            etag = response.headers.get('ETag')
+        self._store(url, data, etag)
+        return data
+
+    def invalidate(self, url=None):
+        with self._lock:
+            if url:
+                self._entries.pop(url, None)
+            else:
+                self._entries.clear()
+
+
+metadata_cache = EsriMetadataCache()
+
 
 class EsriSerializer(object):
     field_types_mapping = {
@@ -20,10 +96,12 @@ class EsriSerializer(object):
         "esriFieldTypeXML": ogr.OFTBinary,
         # "esriFieldTypeGUID": "XXXX",
     }
-    ignored_fields = [
+    ignored_fields = frozenset([
         "SHAPE_Length", "SHAPE_Area", "SHAPE.LEN", "Shape.STLength()",
         "Shape.STArea()"
-    ]
+    ])
+    # postgres identifier length
+    max_column_length = 63
     geometry_types_mapping = {
         "esriGeometryPolygon": ogr.wkbPolygon,
         "esriGeometryPoint": ogr.wkbPoint,
@@ -45,61 +123,106 @@ class EsriSerializer(object):
         "MultiLineString": ogr.wkbMultiLineString,
     }
 
-    def __init__(self, url):
+    def __init__(self, url, session=None, fields=None):
         self._url = url
+        self._session = session
+        # restrict the layer to these service fields
+        self._fields = set(fields) if fields else None
         self._data = None
         self.get_data()
 
     def get_data(self):
-        req = requests.get(self._url + "?f=json")
-        self._data = req.json()
+        self._data = metadata_cache.get(self._url, session=self._session)
         if not self.is_feature_layer:
             raise EsriFeatureLayerException(
                 "This URL {} Is Not A Feature Layer".format(self._url))
 
+    def unique_column(self, column, used):
+        # deterministic rename of colliding columns: name_1, name_2, ...
+        column = column[:self.max_column_length]
+        suffix = 0
+        candidate = column
+        while candidate in used:
+            suffix += 1
+            tail = "_{}".format(suffix)
+            candidate = column[:self.max_column_length - len(tail)] + tail
+        return candidate
+
     def get_fields_list(self):
+        """
+        supported fields of the service, each field has a "column" key
+        with its unique slugified column name
+        """
         data_fields = self._data['fields']
         assert data_fields
         layer_fields = []
-
-        def search_by_name(name):
-            check = False
-            for field in layer_fields:
-                if SLUGIFIER(field["name"]).encode('utf-8') == SLUGIFIER(
-                        name).encode('utf-8'):
-                    check = True
-                    break
-            return check
-
+        used = set()
         for field in data_fields:
-            if field["type"] in self.field_types_mapping.keys(
-            ) and field["name"] not in self.ignored_fields and not search_by_name(
-                    field["name"]):
-                layer_fields.append(field)
+            if field["type"] not in self.field_types_mapping or \
+                    field["name"] in self.ignored_fields:
+                continue
+            if self._fields is not None and field["name"] not in self._fields:
+                continue
+            column = str(SLUGIFIER(field["name"]))
+            if not column:
+                continue
+            column = self.unique_column(column, used)
+            used.add(column)
+            layer_fields.append(dict(field, column=column))
         return layer_fields
 
+    def get_field_columns(self):
+        # esri field name -> column name
+        return dict((field["name"], field["column"])
+                    for field in self.get_fields_list())
+
     def build_fields(self):
         data_fields = self.get_fields_list()
         field_defns = []
         for field in data_fields:
             field_type = field["type"]
-            if str(SLUGIFIER(field["name"])).encode('utf-8'):
-                field_defn = ogr.FieldDefn(
-                    str(SLUGIFIER(field["name"])),
-                    self.field_types_mapping[field_type])
-                if field_type == "esriFieldTypeString" and field.get(
-                        "length", None):
-                    # NOTE: handle large text by WideString
-                    # For Now set max length by default
-                    # field_defn.SetWidth(field["length"])
-                    field_defn.SetWidth(10485760)
-                if field_type in "esriFieldTypeInteger":
-                    field_defn.SetPrecision(64)
-                if field_type != "esriFieldTypeDouble":
-                    field_defn.SetNullable(1)
-                field_defns.append(field_defn)
+            field_defn = ogr.FieldDefn(
+                field["column"], self.field_types_mapping[field_type])
+            if field_type == "esriFieldTypeString" and field.get(
+                    "length", None):
+                # NOTE: handle large text by WideString
+                # For Now set max length by default
+                # field_defn.SetWidth(field["length"])
+                field_defn.SetWidth(10485760)
+            if field_type in "esriFieldTypeInteger":
+                field_defn.SetPrecision(64)
+            if field_type != "esriFieldTypeDouble":
+                field_defn.SetNullable(1)
+            field_defns.append(field_defn)
         return field_defns
 
+    def get_oid_field_name(self):
+        oid_field_name = self._data.get('objectIdField')
+        if not oid_field_name:
+            for field in self._data.get('fields') or []:
+                if field.get('type') == 'esriFieldTypeOID':
+                    oid_field_name = field['name']
+                    break
+        return oid_field_name
+
+    def get_last_edit_date(self):
+        # ms since epoch, None when the service does not track edits
+        return (self._data.get('editingInfo') or {}).get('lastEditDate')
+
+    def get_max_record_count(self, default=500):
+        return self._data.get('maxRecordCount') or default
+
+    def get_edit_date_field(self):
+        return (self._data.get('editFieldsInfo') or {}).get('editDateField')
+
+    def get_schema_hash(self):
+        # changes when the fields, geometry type or projection change
+        schema = [(field["name"], field["type"])
+                  for field in self.get_fields_list()]
+        schema.append(self._data.get("geometryType"))
+        schema.append(self.get_projection().ExportToWkt())
+        return hashlib.sha1(repr(schema).encode('utf-8')).hexdigest()
+
     def get_geometry_type(self):
         geom_type = self.geometry_types_mapping.get(
             self._data.get("geometryType", None), None)
@@ -125,7 +248,8 @@ class EsriSerializer(object):
                 projection_number = srs["latestWkid"]
             elif srs["wkid"] == 102100:
                 projection_number = 3857
-            projection_number = srs["wkid"]
+            else:
+                projection_number = srs["wkid"]
         except:
             projection_number = 4326
         testSR = osr.SpatialReference()
@@ -1,4 +1,5 @@
 # -*- coding: utf-8 -*-
+import threading
 import time
 from contextlib import contextmanager
 from io import BytesIO
@@ -47,15 +48,51 @@ class StyleManager(object):
 
     def __init__(self, gpkg_path):
         self.db_path = gpkg_path
+        # sqlite connections can not be shared between threads so every
+        # thread has its own session: connection, nesting depth and
+        # the cached styles table check
+        self._local = threading.local()
+
+    @property
+    def _conn(self):
+        return getattr(self._local, 'conn', None)
+
+    def __enter__(self):
+        """
+        keep one connection open until the outermost with block
+        of the calling thread exits
+        """
+        local = self._local
+        if not getattr(local, 'depth', 0):
+            local.conn = sqlite3.connect(self.db_path)
+            local.table_exists = False
+            local.depth = 0
+        local.depth += 1
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        local = self._local
+        local.depth -= 1
+        if local.depth == 0:
+            conn, local.conn = local.conn, None
+            local.table_exists = False
+            conn.close()
+        return False
 
     @contextmanager
-    def db_session(self, row_factory=True):
+    def db_session(self, session=None):
+        # an open session is reused and left open for its owner
+        if session is not None:
+            yield session
+            return
+        if self._conn is not None:
+            yield self._conn
+            return
         conn = sqlite3.connect(self.db_path)
-        if row_factory:
-            conn.row_factory = lambda c, r: dict(
-                [(col[0], r[idx]) for idx, col in enumerate(c.description)])
-        yield conn
-        conn.close()
+        try:
+            yield conn
+        finally:
+            conn.close()
 
     def upload_style(self, style_name, sld_body, overwrite=False):
         name = self.get_new_name(style_name)
@@ -96,7 +133,8 @@ class StyleManager(object):
         def wrapper(function):
             def wrapped(*args, **kwargs):
                 this = args[0]
-                if this.check_styles_table_exists():
+                if this.check_styles_table_exists(
+                        session=kwargs.get('session')):
                     return function(*args, **kwargs)
                 return failure_result
 
@@ -104,62 +142,87 @@ class StyleManager(object):
 
         return wrapper
 
-    def check_styles_table_exists(self):
-        check = 0
-        with self.db_session(row_factory=False) as session:
+    def check_styles_table_exists(self, session=None):
+        # only the existence is cached, the table may be created later
+        if self._conn is not None and self._local.table_exists:
+            return True
+        with self.db_session(session=session) as session:
             cursor = session.cursor()
             cursor.execute(
                 """SELECT count(*) FROM sqlite_master \
                 WHERE type="table" AND name=?""", (self.styles_table_name, ))
             result = cursor.fetchone()
             check = result[0]
+        if self._conn is not None:
+            self._local.table_exists = bool(check)
         return check
 
     @staticmethod
-    def from_row(row):
-        return LayerStyle(**unicode_converter(row))
+    def from_row(row, columns):
+        return LayerStyle(**unicode_converter(dict(zip(columns, row))))
+
+    @staticmethod
+    def get_columns(cursor):
+        return [col[0] for col in cursor.description]
 
     @table_exists_decorator(failure_result=[])
-    def get_styles(self):
-        with self.db_session() as session:
+    def get_styles(self, session=None):
+        with self.db_session(session=session) as session:
             cursor = session.cursor()
             cursor.execute('select * from {}'.format(self.styles_table_name))
             rows = cursor.fetchall()
-            styles = [self.from_row(row) for row in rows]
+            columns = self.get_columns(cursor)
+            styles = [self.from_row(row, columns) for row in rows]
             return styles
 
-    def create_table(self):
-        if not self.check_styles_table_exists():
-            with self.db_session() as session:
-                cursor = session.cursor()
-                cursor.execute('''
-                CREATE TABLE {} (
-                                    `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
-                                    `f_table_catalog`	TEXT ( 256 ),
-                                    `f_table_schema`	TEXT ( 256 ),
-                                    `f_table_name`	TEXT ( 256 ),
-                                    `f_geometry_column`	TEXT ( 256 ),
-                                    `styleName`	TEXT ( 30 ),
-                                    `styleQML`	TEXT,
-                                    `styleSLD`	TEXT,
-                                    `useAsDefault`	BOOLEAN,
-                                    `description`	TEXT,
-                                    `owner`	TEXT ( 30 ),
-                                    `ui`	TEXT ( 30 ),
-                                    `update_time`	DATETIME DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
-                                );'''.format(self.styles_table_name))
-                session.commit()
+    def create_index(self, session=None):
+        with self.db_session(session=session) as session:
+            session.execute(
+                'CREATE INDEX IF NOT EXISTS {0}_f_table_name_idx ON {0} '
+                '(f_table_name)'.format(self.styles_table_name))
+            session.commit()
+
+    def create_table(self, session=None):
+        with self.db_session(session=session) as session:
+            try:
+                if not self.check_styles_table_exists(session=session):
+                    cursor = session.cursor()
+                    cursor.execute('''
+                    CREATE TABLE {} (
+                                        `id`	INTEGER PRIMARY KEY AUTOINCREMENT,
+                                        `f_table_catalog`	TEXT ( 256 ),
+                                        `f_table_schema`	TEXT ( 256 ),
+                                        `f_table_name`	TEXT ( 256 ),
+                                        `f_geometry_column`	TEXT ( 256 ),
+                                        `styleName`	TEXT ( 30 ),
+                                        `styleQML`	TEXT,
+                                        `styleSLD`	TEXT,
+                                        `useAsDefault`	BOOLEAN,
+                                        `description`	TEXT,
+                                        `owner`	TEXT ( 30 ),
+                                        `ui`	TEXT ( 30 ),
+                                        `update_time`	DATETIME DEFAULT (strftime('%Y-%m-%dT%H:%M:%fZ','now'))
+                                    );'''.format(self.styles_table_name))
+                    session.commit()
+                self.create_index(session=session)
+            except BaseException:
+                # the table may not exist, check it again next time
+                if self._conn is not None:
+                    self._local.table_exists = False
+                raise
+        if self._conn is not None:
+            self._local.table_exists = True
 
     @table_exists_decorator(failure_result=None)
-    def get_style(self, layername):
-        with self.db_session() as session:
+    def get_style(self, layername, session=None):
+        with self.db_session(session=session) as session:
             cursor = session.cursor()
             cursor.execute(
                 'SELECT * FROM {} WHERE f_table_name=?'.format(
                     self.styles_table_name), (layername, ))
-            rows = cursor.fetchone()
-            if rows and len(rows):
-                return self.from_row(rows)
+            row = cursor.fetchone()
+            if row:
+                return self.from_row(row, self.get_columns(cursor))
             else:
                 return None
 
@@ -180,9 +243,10 @@ class StyleManager(object):
                   geom_field,
                   stylename,
                   sld_body,
-                  default=False):
+                  default=False,
+                  session=None):
         # sld_body = self.convert_sld_attributes(sld_body)
-        with self.db_session() as session:
+        with self.db_session(session=session) as session:
             cursor = session.cursor()
             cursor.execute(
                 'INSERT INTO {} (f_table_name,f_geometry_column,styleName,styleSLD,useAsDefault) VALUES (?,?,?,?,?);'.
@@ -191,4 +255,18 @@ class StyleManager(object):
             session.commit()
             return cursor.lastrowid
 
-    # TODO: add_styles with executemany
+    @table_exists_decorator(failure_result=0)
+    def add_styles(self, styles, default=False, session=None):
+        """
+        insert (layername, geom_field, stylename, sld_body) tuples
+        in one transaction, returns the number of inserted styles
+        """
+        rows = [tuple(style) + (default, ) for style in styles]
+        with self.db_session(session=session) as session:
+            # commit, or roll back the partial batch on errors so a
+            # shared session does not commit it later
+            with session:
+                session.executemany(
+                    'INSERT INTO {} (f_table_name,f_geometry_column,styleName,styleSLD,useAsDefault) VALUES (?,?,?,?,?);'.
+                    format(self.styles_table_name), rows)
+        return len(rows)
@@ -1,34 +1,60 @@
 # from celery import shared_task
 from geonode.celery_app import app
+from geonode.people.models import Profile
 from django.conf import settings
 from django.core.mail import EmailMessage
 from django.urls import reverse
+from esridump.errors import EsriDownloadError
+from requests.exceptions import ConnectionError
 
 from cartoview.log_handler import get_logger
 
 from .esri_handler import EsriHandler
 from .handlers import DataManager
 from .helpers import urljoin
+from .models import EsriLayerSync, GpkgUpload
+from .publishers import (POSTGIS_DEFERRED_INDEXES, POSTGIS_MAINTENANCE_WORKERS,
+                         PackageLayerPublisher)
 logger = get_logger(__name__)
 
+ESRI_IMPORT_RETRIES = getattr(settings, 'DATA_MANAGER_ESRI_IMPORT_RETRIES', 3)
+ESRI_RETRY_DELAY = getattr(settings, 'DATA_MANAGER_ESRI_RETRY_DELAY', 60)
+
 
 @app.task(bind=True)
-def backup_portal_layer(self):
-    path = DataManager.backup_portal()
+def backup_portal_layer(self, differential=False):
+    def progress(event):
+        self.update_state(state='PROGRESS', meta=event)
+
+    path = DataManager.backup_portal(
+        differential=differential, progress=progress)
     return path
 
 
-@app.task(bind=True)
+@app.task(bind=True, max_retries=ESRI_IMPORT_RETRIES)
 def esri_from_url(self,
                   url,
                   useremail=None,
                   overwrite=False,
                   temporary=False,
                   launder=False,
-                  name=None):
-
-    eh = EsriHandler(url)
-    geonode_layer = eh.publish()
+                  name=None,
+                  options=None):
+    # options: where, envelope, envelope_sr, out_fields and out_sr
+    eh = EsriHandler(url, **(options or {}))
+    # retries resume from the checkpoint of the failed attempt
+    eh.import_owner = self.request.id or eh.import_owner
+    try:
+        geonode_layer = eh.publish(
+            resumable=True,
+            deferred_indexes=POSTGIS_DEFERRED_INDEXES,
+            maintenance_workers=POSTGIS_MAINTENANCE_WORKERS)
+    except (EsriDownloadError, ConnectionError) as e:
+        logger.error(e)
+        if self.request.retries < self.max_retries:
+            raise self.retry(exc=e, countdown=ESRI_RETRY_DELAY)
+        geonode_layer = None
+        eh.abandon_import()
     layer_url = None
     message = None
     mail_on = settings.EMAIL_ENABLE if hasattr(
@@ -49,3 +75,79 @@ def esri_from_url(self,
             from_email=settings.DEFAULT_FROM_EMAIL)
         msg.send()
     return layer_url
+
+
+@app.task(bind=True, max_retries=ESRI_IMPORT_RETRIES)
+def esri_to_gpkg_download(self, url, user_id, file_name=None, options=None):
+    from .rest import ManagerDownloadResource
+    from .urls import api
+    user = Profile.objects.get(pk=user_id)
+    eh = EsriHandler(url, **(options or {}))
+    try:
+        download = eh.export_download(user, file_name=file_name)
+    except (EsriDownloadError, ConnectionError) as e:
+        logger.error(e)
+        raise self.retry(exc=e, countdown=ESRI_RETRY_DELAY)
+    download_url = reverse(
+        'api_manager_download',
+        kwargs={
+            "resource_name": ManagerDownloadResource.Meta.resource_name,
+            "pk": download.id,
+            "api_name": api.api_name
+        })
+    return {
+        "download_id": download.id,
+        "download_url": urljoin(settings.SITEURL, download_url.lstrip('/'))
+    }
+
+
+@app.task(bind=True, max_retries=ESRI_IMPORT_RETRIES)
+def esri_sync_layer(self, layername):
+    state = EsriLayerSync.objects.get(layer_name=layername)
+    eh = EsriHandler(state.url, **state.get_options())
+    try:
+        upserted, deleted = eh.sync_layer(state)
+    except (EsriDownloadError, ConnectionError) as e:
+        logger.error(e)
+        raise self.retry(exc=e, countdown=ESRI_RETRY_DELAY)
+    return {"layer": layername, "upserted": upserted, "deleted": deleted}
+
+
+@app.task(bind=True)
+def publish_package_layer(self,
+                          upload_id,
+                          layername,
+                          user_id,
+                          publish_name=None,
+                          replace=False):
+    def progress(stage, step, total):
+        self.update_state(
+            state='PROGRESS',
+            meta={"stage": stage, "step": step, "total": total})
+
+    upload = GpkgUpload.objects.get(pk=upload_id)
+    user = Profile.objects.get(pk=user_id)
+    publisher = PackageLayerPublisher(
+        upload.data_manager, upload.style_manager, user, progress=progress)
+    layer = publisher.publish(
+        layername, publish_name=publish_name, replace=replace)
+    layer_url = reverse(
+        'layer_detail', kwargs={"layername": layer.alternate})
+    return {
+        "alternate": layer.alternate,
+        "layer_url": urljoin(settings.SITEURL, layer_url.lstrip('/'))
+    }
+
+
+@app.task(bind=True)
+def publish_package_layers(self, upload_id, layernames, user_id):
+    def progress(stage, step, total):
+        self.update_state(
+            state='PROGRESS',
+            meta={"stage": stage, "step": step, "total": total})
+
+    upload = GpkgUpload.objects.get(pk=upload_id)
+    user = Profile.objects.get(pk=user_id)
+    publisher = PackageLayerPublisher(
+        upload.data_manager, upload.style_manager, user, progress=progress)
+    return publisher.publish_many(layernames)
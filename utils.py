@@ -1,6 +1,7 @@
 # -*- coding: utf-8 -*-
 import functools
 import os
+import threading
 import time
 from uuid import uuid4
 
@@ -12,13 +13,17 @@ from requests.packages.urllib3.util.retry import Retry
 from django.utils.text import slugify
 
 from cartoview.app_manager.helpers import create_direcotry
+from cartoview.log_handler import get_logger
 from geonode.geoserver.helpers import (get_store, gs_catalog,
                                        ogc_server_settings)
 from geonode.geoserver.helpers import create_geoserver_db_featurestore
 
 from .constants import _temp_dir
 
+logger = get_logger(__name__)
+
 DEFAULT_WORKSPACE = settings.DEFAULT_WORKSPACE
+POSTGIS_HEALTH_TTL = getattr(settings, 'DATA_MANAGER_POSTGIS_HEALTH_TTL', 5)
 
 
 def SLUGIFIER(text):
@@ -33,8 +38,8 @@ def get_new_dir(base_dir=_temp_dir):
     return target
 
 
-def get_sld_body(url):
-    req = requests.get(
+def get_sld_body(url, session=None):
+    req = (session or requests).get(
         url,
         auth=HTTPBasicAuth(ogc_server_settings.credentials[0],
                            ogc_server_settings.credentials[1]))
@@ -63,11 +68,10 @@ def create_datastore(store_name=None, store_type=None):
 
 def _psycopg2(conn_str):
     try:
-        import psycopg2
-        conn = psycopg2.connect(conn_str)
-        cur = conn.cursor()
-        cur.execute("SELECT version();")
-        conn.close()
+        from .pools import get_psycopg2_pool
+        with get_psycopg2_pool(conn_str).connection() as conn:
+            cur = conn.cursor()
+            cur.execute("SELECT version();")
         connected = True
     except BaseException:
         connected = False
@@ -82,13 +86,89 @@ def _django_connection():
         conn.connect()
         cur = conn.cursor()
         cur.execute("SELECT version();")
-        conn.close()
         connected = True
     except BaseException:
         connected = False
     return connected
 
 
+def _close_django_connection():
+    # connections are per thread, the refresh threads would leak them
+    try:
+        from django.db import connections
+        ds_conn_name = ogc_server_settings.server.get('DATASTORE', None)
+        connections[ds_conn_name].close()
+    except BaseException as e:
+        logger.warning(e)
+
+
+class PostgisHealth(object):
+    """
+    shared postgis liveness state, a stale result is served while
+    a background thread refreshes it so requests never wait on the probe
+    except for the very first check.
+    """
+
+    def __init__(self, ttl=POSTGIS_HEALTH_TTL):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        # only one probe runs at a time
+        self._probe_lock = threading.Lock()
+        self._connected = None
+        self._checked_at = 0
+        self._refreshing = False
+
+    @staticmethod
+    def probe(conn_str):
+        connected = _psycopg2(conn_str)
+        if not connected:
+            connected = _django_connection()
+        return connected
+
+    def _update(self, conn_str):
+        connected = self.probe(conn_str)
+        with self._lock:
+            self._connected = connected
+            self._checked_at = time.time()
+        return connected
+
+    def refresh(self, conn_str):
+        # runs in its own thread, the request connections are left alone
+        try:
+            with self._probe_lock:
+                return self._update(conn_str)
+        finally:
+            _close_django_connection()
+            self._refreshing = False
+
+    def first_check(self, conn_str):
+        # concurrent first checks wait for the running probe
+        with self._probe_lock:
+            with self._lock:
+                connected = self._connected
+            if connected is not None:
+                return connected
+            return self._update(conn_str)
+
+    def is_connected(self, conn_str):
+        with self._lock:
+            connected = self._connected
+            stale = time.time() - self._checked_at > self.ttl
+            refresh = stale and not self._refreshing and connected is not None
+            if refresh:
+                self._refreshing = True
+        if connected is None:
+            return self.first_check(conn_str)
+        if refresh:
+            thread = threading.Thread(target=self.refresh, args=(conn_str, ))
+            thread.daemon = True
+            thread.start()
+        return connected
+
+
+postgis_health = PostgisHealth()
+
+
 def requests_retry_session(retries=3,
                            backoff_factor=0.3,
                            status_forcelist=(500, 502, 504),
@@ -24,7 +24,7 @@ from .decorators import time_it
 from .exceptions import GpkgLayerException
 from .forms import GpkgUploadForm
 from .handlers import DataManager, get_connection
-from .models import GpkgUpload
+from .models import GpkgUpload, LayerSchema
 from .publishers import GeonodePublisher, GeoserverPublisher
 from .style_manager import StyleManager
 from .utils import SLUGIFIER, get_sld_body
@@ -46,25 +46,32 @@ def get_compatible_layers(request, upload_id, layername):
     permitted_layers = Layer.objects.filter(id__in=permitted)
     try:
         obj = GpkgUpload.objects.get(id=upload_id)
+        gpkg_layer = obj.data_manager.get_layer_by_name(layername)
+        if not gpkg_layer:
+            raise GpkgLayerException("No Layer with this name in the package")
+        tables = {
+            str(layer.alternate).split(":").pop(): layer
+            for layer in permitted_layers
+        }
+        # only the layers of the schema index are listed, comparing
+        # every other table field by field scans the whole datastore
+        compatible = LayerSchema.compatible_tables(gpkg_layer,
+                                                   list(tables.keys()))
         layers = []
-        for layer in permitted_layers:
-            try:
-                check = obj.data_manager.check_schema_geonode(
-                    layername, str(layer.alternate))
-                lyr = {
-                    "name": layer.alternate,
-                    "deleted_fields": check.get("deleted_fields"),
-                    "new_fields": check.get("new_fields"),
-                    "urls": {
-                        "reload_url":
-                        reverse(
-                            'reload_layer',
-                            args=(upload_id, layername, layer.alternate))
-                    }
+        for table_name in sorted(compatible):
+            layer = tables[table_name]
+            lyr = {
+                "name": layer.alternate,
+                "deleted_fields": [],
+                "new_fields": [],
+                "urls": {
+                    "reload_url":
+                    reverse(
+                        'reload_layer',
+                        args=(upload_id, layername, layer.alternate))
                 }
-                layers.append(lyr)
-            except Exception as e:
-                logger.error(e)
+            }
+            layers.append(lyr)
 
         data = {"status": "success", "layers": layers}
         status = 200
@@ -95,10 +102,11 @@ def reload_layer(request, upload_id, layername, glayername):
                                                      str(layer.alternate)):
             raise GpkgLayerException("Invalid schema")
         geonode_manager = DataManager(get_connection(), is_postgis=True)
-        gpkg_layer.copy_to_source(
+        table_name = gpkg_layer.copy_to_source(
             geonode_manager.source,
             overwrite=True,
             name=glayername.split(":").pop())
+        LayerSchema.index_source_tables(geonode_manager.source, [table_name])
         data = {"status": "success", "message": "Layer reloaded succesfully"}
         status = 200
     except (GpkgUpload.DoesNotExist, Layer.DoesNotExist,
@@ -339,8 +347,7 @@ def download_layers(request):
                                      get_sld_body(sld_url)))
         DataManager.postgis_as_gpkg(
             get_connection(), package_path, layernames=table_names)
-        stm = StyleManager(package_path)
-        stm.create_table()
-        for style in layer_styles:
-            stm.add_style(*style, default=True)
+        with StyleManager(package_path) as stm:
+            stm.create_table()
+            stm.add_styles(layer_styles, default=True)
         return redirect(os.path.join(settings.MEDIA_URL, package_url))